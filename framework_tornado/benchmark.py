@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import time
+import platform
+import logging
+import collections
+
+import tornado
+import tornado.gen
+import tornado.ioloop
+import tornado.testing
+import tornado.httpserver
+from tornado.options import define, options, parse_command_line
+
+import http_server
+from http_client import AsyncHTTPClient
+from loadgen import LoadGenerator
+
+"""
+    路由基准测试
+
+    与 tornado.testing 一样，在当前进程中启动 Application 并监听本机的随机端口，
+    依次对路由表中的各类路由进行闭环压测，记录吞吐量与延迟分位数
+
+    用法：
+        记录基准：python benchmark.py --output=baseline.json
+        对比基准：python benchmark.py --compare=baseline.json --threshold=0.15
+        只测部分路由：python benchmark.py --routes=main,need-auth
+
+    对比模式下，任一路由的吞吐量下降或 p50 延迟上升超过 threshold（比例）时，以状态码 1 退出
+
+    注意：
+        1.压测客户端与服务运行在同一个 IOLoop 上，结果只用于前后对比，不代表服务的绝对性能
+        2.转发类路由（/async-ssr、/coroutine）的上游地址指向同一服务的 /now 路由，不访问外网
+        3.对比结果受机器负载影响，基准文件应在同一台机器上生成
+"""
+
+Scenario = collections.namedtuple('Scenario', ['name', 'method', 'path', 'body', 'auth'])
+
+FORM_POEM = 'noun1=roads&noun2=wood&verb=made&noun3=difference'
+
+SCENARIOS = [
+    # 路由解析
+    Scenario('main', 'GET', '/', None, False),
+    Scenario('now', 'GET', '/now', None, False),
+    Scenario('number', 'GET', '/number/42', None, False),
+    Scenario('date', 'GET', '/date/2019/5/21', None, False),
+    # 接入点函数
+    Scenario('something', 'GET', '/something', None, False),
+    # 输入捕获
+    Scenario('input-catch-arg', 'GET', '/input-catch-arg?arg=a&args=b&args=c', None, False),
+    Scenario('input-catch-req', 'GET', '/input-catch-req?q=benchmark', None, False),
+    # 异步化处理与协程化处理
+    Scenario('async-ssr', 'GET', '/async-ssr', None, False),
+    Scenario('coroutine', 'GET', '/coroutine', None, False),
+    # 身份验证
+    Scenario('auth-sec-cookies', 'GET', '/auth-sec-cookies', None, False),
+    Scenario('login', 'POST', '/login', 'name=benchmark', False),
+    Scenario('need-auth', 'GET', '/need-auth', None, True),
+    # 表单与模板
+    Scenario('poem-index', 'GET', '/poem-index', None, False),
+    Scenario('poem-page', 'POST', '/poem-page', FORM_POEM, False),
+    Scenario('poem-page-temp', 'POST', '/poem-page-temp', FORM_POEM, False),
+    Scenario('func-temp', 'GET', '/func-temp', None, False),
+    # 模板扩展
+    Scenario('inherit-temp', 'GET', '/inherit-temp?inherit=1', None, False),
+    Scenario('ui-module-temp', 'GET', '/ui-module-temp', None, False),
+]
+
+
+@tornado.gen.coroutine
+def login_cookie(base_url):
+    # 登录后返回带有 session_id 的 Cookie 请求头
+    http_client = AsyncHTTPClient(force_instance=True)
+    response = yield http_client.fetch(base_url + '/login', method='POST', body='name=benchmark',
+                                       follow_redirects=False, raise_error=False)
+    http_client.close()
+    cookies = [header.split(';', 1)[0] for header in response.headers.get_list('Set-Cookie')]
+    raise tornado.gen.Return('; '.join(cookies))
+
+
+@tornado.gen.coroutine
+def run_scenario(base_url, scenario, cookie, concurrency, duration, warmup):
+    headers = {}
+    if scenario.body:
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    if scenario.auth:
+        headers['Cookie'] = cookie
+    url = base_url + scenario.path
+    if warmup > 0:
+        generator = LoadGenerator(url, scenario.method, scenario.body, headers)
+        yield generator.closed_loop(concurrency, warmup)
+        generator.close()
+    generator = LoadGenerator(url, scenario.method, scenario.body, headers)
+    result = yield generator.closed_loop(concurrency, duration)
+    generator.close()
+    summary = result.histogram.summary()
+    raise tornado.gen.Return({
+        'requests': result.requests,
+        'errors': result.errors,
+        'rps': result.requests / result.elapsed,
+        'mean_ms': summary['mean'] / 1000.0,
+        'p50_ms': summary['p50'] / 1000.0,
+        'p90_ms': summary['p90'] / 1000.0,
+        'p99_ms': summary['p99'] / 1000.0,
+        'p99.9_ms': summary['p99.9'] / 1000.0,
+    })
+
+
+@tornado.gen.coroutine
+def run_benchmark(scenarios, concurrency, duration, warmup):
+    sock, port = tornado.testing.bind_unused_port()
+    base_url = 'http://127.0.0.1:%d' % port
+    app = http_server.make_app(upstream_url=base_url + '/now')
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets([sock])
+
+    cookie = yield login_cookie(base_url)
+    results = collections.OrderedDict()
+    for scenario in scenarios:
+        result = yield run_scenario(base_url, scenario, cookie, concurrency, duration, warmup)
+        results[scenario.name] = result
+        print('%-18s %8.0f req/sec  p50 %6.2fms  p90 %6.2fms  p99 %6.2fms  p99.9 %6.2fms  errors %d' % (
+            scenario.name, result['rps'], result['p50_ms'], result['p90_ms'],
+            result['p99_ms'], result['p99.9_ms'], result['errors']))
+    server.stop()
+    raise tornado.gen.Return(results)
+
+
+def compare(baseline, results, threshold):
+    # 返回退化的路由列表
+    regressions = []
+    for name, result in results.items():
+        base = baseline['routes'].get(name)
+        if base is None:
+            continue
+        rps_change = result['rps'] / base['rps'] - 1 if base['rps'] else 0.0
+        p50_change = result['p50_ms'] / base['p50_ms'] - 1 if base['p50_ms'] else 0.0
+        regressed = rps_change < -threshold or p50_change > threshold
+        print('%-18s rps %+6.1f%%  p50 %+6.1f%%%s' % (
+            name, rps_change * 100, p50_change * 100, '  REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    define(name='output', default=None, help='Write results to this JSON baseline file', type=str)
+    define(name='compare', default=None, help='Compare results with this JSON baseline file', type=str)
+    define(name='threshold', default=0.15, help='Allowed regression ratio in compare mode', type=float)
+    define(name='routes', default=None, help='Comma separated scenario names to run', type=str)
+    define(name='concurrency', default=20, help='Concurrent users per route', type=int)
+    define(name='duration', default=2.0, help='Seconds to measure each route', type=float)
+    define(name='warmup', default=0.5, help='Seconds to warm up each route', type=float)
+    parse_command_line()
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
+
+    scenarios = SCENARIOS
+    if options.routes:
+        names = options.routes.split(',')
+        scenarios = [scenario for scenario in SCENARIOS if scenario.name in names]
+
+    results = tornado.ioloop.IOLoop.current().run_sync(
+        lambda: run_benchmark(scenarios, options.concurrency, options.duration, options.warmup))
+
+    failed = [name for name, result in results.items() if result['errors']]
+    if failed:
+        print('Routes with error responses: %s' % ', '.join(failed))
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'python': platform.python_version(),
+                    'tornado': tornado.version,
+                    'concurrency': options.concurrency,
+                    'duration': options.duration,
+                },
+                'routes': results,
+            }, f, indent=2)
+        print('Results written to %s' % options.output)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, options.threshold)
+        if regressions:
+            print('Regressed routes (threshold %.0f%%): %s' % (options.threshold * 100, ', '.join(regressions)))
+            return 1
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import time
+import zlib
+import hashlib
+import threading
+
+from render_cache import template_files
+
+"""
+    条件请求与缓存策略
+
+    Tornado 默认在 finish 时对完整的响应体计算 sha1 作为 Etag，
+    请求的 If-None-Match 与之相同时返回 304，这样只节省了传输，渲染（或者生成响应）的开销一点没少
+
+    ConditionalMixin 让处理器在 prepare 阶段声明一个廉价的校验值（validator）：
+        1.get_validator() 返回决定输出内容的所有输入（路由参数、查询参数、模板版本等），返回 None 表示不支持
+        2.Etag 为 W/"sha1(处理器类名, validator_version, validator)"，
+          弱校验值（W/）表示不同的 Content-Encoding 共用同一个 Etag
+        3.If-None-Match 命中时在 prepare 中直接返回 304，get 不会执行，模板不会渲染
+        4.Etag 已经设置时 Tornado 不会再对响应体计算 sha1
+        5.cache_control 类属性为该路由的 Cache-Control 策略，200 与 304 响应都会带上
+
+    template_version(template_name) 返回模板及其 extends / include 的文件的修改时间摘要，
+    修改模板后 Etag 随之改变，每个模板最多每 check_interval 秒检查一次文件
+
+    注意：
+        1.validator 必须覆盖所有影响输出的输入，处理器代码修改后应当修改 validator_version
+        2.多台机器部署时，模板文件的修改时间应当一致（比如由同一个部署包解压），否则 Etag 不一致只会导致多余的 200
+"""
+
+
+class TemplateVersions(object):
+
+    def __init__(self, check_interval=1.0):
+        self.check_interval = check_interval
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, template_path, template_name):
+        key = (template_path, template_name)
+        now = time.monotonic()
+        item = self._versions.get(key)
+        if item is not None and now - item[1] < self.check_interval:
+            return item[0]
+        files = template_files(template_path, template_name)
+        version = '%08x' % zlib.crc32(repr(sorted(files.items())).encode('utf-8'))
+        with self._lock:
+            self._versions[key] = (version, now)
+        return version
+
+
+TEMPLATE_VERSIONS = TemplateVersions()
+
+
+class ConditionalMixin(object):
+    """
+        RequestHandler 混入类
+
+        子类重写 get_validator 返回校验值，并可设置 cache_control 类属性
+    """
+
+    cache_control = None
+
+    validator_version = '1'
+
+    def get_validator(self):
+        return None
+
+    def template_version(self, template_name):
+        return TEMPLATE_VERSIONS.get(self.get_template_path(), template_name)
+
+    def prepare(self):
+        if self.cache_control is not None:
+            self.set_header('Cache-Control', self.cache_control)
+        if self.request.method in ('GET', 'HEAD'):
+            validator = self.get_validator()
+            if validator is not None:
+                digest = hashlib.sha1(repr((self.__class__.__name__, self.validator_version, validator))
+                                      .encode('utf-8')).hexdigest()
+                self.set_header('Etag', 'W/"%s"' % digest)
+                if self.check_etag_header():
+                    self.set_status(304)
+                    self.finish()
+                    return
+        return super(ConditionalMixin, self).prepare()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+import time
+from collections import OrderedDict
+
+"""
+    安全 Cookie 校验缓存
+
+    RequestHandler.get_secure_cookie 每次都要解析签名 Cookie 的各个字段、
+    计算 HMAC-SHA256 并比较签名、再 base64 解码，
+    同一个用户的每个请求都带着同一个签名 Cookie，重复校验是没有必要的
+
+    SecureCookieCache 以 (Cookie 名, 签名 Cookie 的原始值) 为键缓存校验通过的值，命中时只需一次字典查找：
+        1.只有校验通过的 Cookie 才会进入缓存，伪造的 Cookie 每次都会重新校验（并且失败）
+        2.条目的过期时间为 Cookie 中的签名时间戳 + max_age_days，与 get_secure_cookie 的过期判断一致
+        3.条目数不超过 max_entries，超出时按 LRU 规则淘汰
+        4.键中不包含 Cookie 请求头的其他部分：其他 Cookie（统计、CSRF 等）变化时仍然命中，
+          客户端也无法通过附加无关的 Cookie 制造大量条目（每个条目都需要一个校验通过的签名值）
+
+    缓存的是 Cookie 中的会话 ID，而不是用户身份：
+    用户身份仍然每次从会话存储中读取，会话过期或被删除（比如退出登录）后立即生效
+
+    注意：
+        1.缓存属于某一个 Application（settings['cookie_cache']），更换 cookie_secret 时必须创建新的缓存
+        2.只在 IOLoop 线程中访问，没有加锁
+        3.RequestHandler.current_user 本身会缓存 get_current_user 的结果，同一个请求中只会调用一次
+"""
+
+
+def signed_timestamp(signed_value):
+    # 返回签名 Cookie 中的时间戳, 格式参考 tornado.web.create_signed_value
+    parts = signed_value.split('|')
+    try:
+        if parts[0] == '2':
+            # 2|1:0|10:1558600000|10:session_id|48:...|签名
+            return int(parts[2].split(':', 1)[1])
+        # 值|1558600000|签名
+        return int(parts[1])
+    except (IndexError, ValueError):
+        return None
+
+
+class SecureCookieCache(object):
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.expirations = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def get_secure_cookie(self, handler, name, max_age_days=31):
+        # 与 handler.get_secure_cookie(name) 的结果相同, 返回 str, Cookie 不存在或者校验失败时返回 None
+        raw = handler.get_cookie(name)
+        if raw is None:
+            return None
+        key = (name, raw)
+        entry = self._entries.get(key)
+        now = time.time()
+        if entry is not None:
+            if now < entry[1]:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            del self._entries[key]
+            self.expirations += 1
+        self.misses += 1
+        value = handler.get_secure_cookie(name, value=raw, max_age_days=max_age_days)
+        if value is None:
+            self.failures += 1
+            return None
+        value = value.decode('utf-8')
+        timestamp = signed_timestamp(raw)
+        if timestamp is not None and self.max_entries > 0:
+            self._entries[key] = (value, timestamp + max_age_days * 86400)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'failures': self.failures,
+            'expirations': self.expirations,
+            'evictions': self.evictions,
+        }
+
+
+"""
+    安全 Cookie 校验缓存 - 基准测试
+
+    1.比较 get_secure_cookie 与 SecureCookieCache.get_secure_cookie 的单次耗时（包括创建 RequestHandler）
+    2.在子进程中启动 http_server，登录后以 --concurrency 个虚拟用户压测 /need-auth --duration 秒，
+      比较关闭（--cookie_cache_size=0）与开启缓存时的吞吐量与延迟，
+      请求同时带有一个无关的统计 Cookie，与浏览器的实际请求一致
+
+    python cookie_cache.py --number=100000 --concurrency=20 --duration=10
+
+    本机结果（单核，压测进程与服务共用一个 CPU，三次运行）：
+        单次调用：创建 RequestHandler 约 4.3 us，get_secure_cookie 约 11.9 us，命中 SecureCookieCache 约 7.9 us
+        （解析 Cookie 请求头仍然每次进行，校验部分从约 7.5 us 降到约 3.5 us）
+        /need-auth：关闭缓存 4091 ~ 4514 次/秒，p50 4.1 ~ 4.7 ms；开启缓存 4471 ~ 4933 次/秒，p50 3.8 ~ 4.0 ms
+"""
+
+
+def benchmark(number, concurrency, duration, port):
+    import timeit
+    import tornado.web
+    from tornado.httputil import HTTPHeaders, HTTPServerRequest
+
+    class Connection(object):
+        def set_close_callback(self, callback):
+            pass
+
+    app = tornado.web.Application(cookie_secret='SALT')
+    signed = tornado.web.create_signed_value('SALT', 'session_id', 'd5f0a0c2-7f2b-11e9-8f9e-2a86e4085a59')
+    request = HTTPServerRequest(uri='/need-auth', connection=Connection(),
+                                headers=HTTPHeaders({'Cookie': 'session_id=%s' % signed.decode()}))
+    cache = SecureCookieCache()
+
+    def uncached():
+        # 每个请求都是新的 RequestHandler, 清除已解析的 Cookie
+        request.__dict__.pop('_cookies', None)
+        return tornado.web.RequestHandler(app, request).get_secure_cookie('session_id')
+
+    def cached():
+        request.__dict__.pop('_cookies', None)
+        return cache.get_secure_cookie(tornado.web.RequestHandler(app, request), 'session_id')
+
+    def handler_only():
+        request.__dict__.pop('_cookies', None)
+        return tornado.web.RequestHandler(app, request)
+
+    assert uncached().decode() == cached()
+    for name, func in (('RequestHandler()', handler_only), ('get_secure_cookie', uncached),
+                       ('SecureCookieCache', cached)):
+        elapsed = timeit.timeit(func, number=number)
+        print('%-20s %6.2f us/op' % (name, elapsed / number * 1e6))
+    need_auth(concurrency, duration, port)
+
+
+def need_auth(concurrency, duration, port):
+    import multiprocessing
+    import tornado.gen
+    import tornado.ioloop
+    from tornado.httpclient import AsyncHTTPClient
+    from tornado.options import options
+    from loadgen import LoadGenerator, serve
+
+    @tornado.gen.coroutine
+    def run(base):
+        client = AsyncHTTPClient(force_instance=True)
+        response = yield client.fetch(base + '/login', method='POST', body='name=benchmark', follow_redirects=False,
+                                      raise_error=False)
+        client.close()
+        cookies = [header.split(';', 1)[0] for header in response.headers.get_list('Set-Cookie')]
+        cookies.append('_ga=GA1.1.1234567890.1558600000')
+        generator = LoadGenerator(base + '/need-auth', headers={'Cookie': '; '.join(cookies)},
+                                  max_clients=concurrency)
+        yield generator.closed_loop(concurrency, 1)
+        result = yield generator.closed_loop(concurrency, duration)
+        generator.close()
+        raise tornado.gen.Return(result)
+
+    # 只比较认证的开销, 关闭准入控制
+    options.admission = False
+    cache_size = options.cookie_cache_size or 10000
+    for name, size in (('/need-auth no cache', 0), ('/need-auth cached', cache_size)):
+        options.cookie_cache_size = size
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=serve, args=(port, ready), daemon=True)
+        server.start()
+        ready.wait()
+        try:
+            result = tornado.ioloop.IOLoop.current().run_sync(lambda: run('http://127.0.0.1:%d' % port))
+            summary = result.histogram.summary()
+            print('%-20s %8.0f req/sec  p50 %6.2f ms  p99 %6.2f ms  errors %d' % (
+                name, result.requests / result.elapsed, summary['p50'] / 1000.0, summary['p99'] / 1000.0,
+                result.errors))
+        finally:
+            server.terminate()
+            server.join()
+        port += 1
+
+
+if __name__ == '__main__':
+    # 导入 http_server 以定义 port、cookie_cache_size 等选项
+    import http_server
+    from tornado.options import define, options, parse_command_line
+    define(name='number', default=100000, help='Lookups per case', type=int)
+    define(name='concurrency', default=20, help='Concurrent users requesting /need-auth', type=int)
+    define(name='duration', default=10, help='Seconds per /need-auth case', type=float)
+    parse_command_line()
+    benchmark(options.number, options.concurrency, options.duration, options.port)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import math
+
+"""
+    延迟直方图（HDR 风格）
+
+    保存所有延迟样本再排序求分位数，内存随样本数增长
+    LatencyHistogram 参考 HdrHistogram 的对数-线性分桶，用固定精度换取固定的内存：
+        1.小于 sub_bucket_count 的值每个值一个桶（线性部分）
+        2.更大的值按 2 的幂分段，每段再均分为 sub_bucket_count / 2 个桶
+        3.significant_figures=2 时相对误差小于 1%，记录一亿次也只占用几 KB 内存
+
+    记录的值为非负整数，单位由调用者决定（比如微秒）
+    percentile 返回对应桶的上界（与 HdrHistogram 的 highest equivalent value 一致），并且不超过实际的最大值
+"""
+
+
+class LatencyHistogram(object):
+
+    def __init__(self, significant_figures=2):
+        self.significant_figures = significant_figures
+        self.sub_bucket_bits = int(math.ceil(math.log(2 * 10 ** significant_figures, 2)))
+        self.sub_bucket_count = 1 << self.sub_bucket_bits
+        self.sub_bucket_half = self.sub_bucket_count // 2
+        self.counts = [0] * self.sub_bucket_count
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        if value < self.sub_bucket_count:
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits
+        top = value >> shift
+        return self.sub_bucket_count + (shift - 1) * self.sub_bucket_half + top - self.sub_bucket_half
+
+    def _upper(self, index):
+        if index < self.sub_bucket_count:
+            return index
+        offset = index - self.sub_bucket_count
+        shift = offset // self.sub_bucket_half + 1
+        top = offset % self.sub_bucket_half + self.sub_bucket_half
+        return ((top + 1) << shift) - 1
+
+    def record(self, value, count=1):
+        value = int(value)
+        if value < 0:
+            raise ValueError('Histogram values must be non-negative: %d' % value)
+        index = self._index(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if other.sub_bucket_bits != self.sub_bucket_bits:
+            raise ValueError('Histograms must have the same precision')
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def percentile(self, percent):
+        if self.count == 0:
+            return 0
+        target = max(1, int(math.ceil(self.count * percent / 100.0)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self._upper(index), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / float(self.count) if self.count else 0.0
+
+    def summary(self, percents=(50, 90, 99, 99.9)):
+        result = {
+            'count': self.count,
+            'min': self.min or 0,
+            'mean': self.mean,
+            'max': self.max or 0,
+        }
+        for percent in percents:
+            result['p%s' % ('%g' % percent)] = self.percentile(percent)
+        return result
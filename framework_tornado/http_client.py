@@ -2,11 +2,22 @@
 # author: BergChen
 # date: 2019/5/20
 
+import random
+import collections
+from urllib.parse import urlsplit
 from tornado import ioloop
 from tornado import gen
+from tornado import locks
+from tornado import queues
 from tornado.httpclient import HTTPClient
 from tornado.httpclient import AsyncHTTPClient
 
+try:
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+    # pycurl 未安装
+    CurlAsyncHTTPClient = None
+
 """
     Tornado 同步请求
 """
@@ -118,3 +129,348 @@ if __name__ == '__main__':
     # io_loop = ioloop.IOLoop.current()
     # io_loop.run_sync(async_visit_contains_more_wait_by_coroutine)
     pass
+
+"""
+    Tornado 异步请求 - 协程函数 - 限制并发的批量请求
+
+    一次 yield 所有请求时，所有请求会同时发出，并且要等最慢的请求完成后才能拿到全部结果
+    URL 数量很多时（比如上万个），会同时打开上万个连接并在内存中保留所有响应
+
+    BulkFetcher 按需从 URL 序列中取出 URL 发起请求：
+        1.concurrency 限制同时进行的请求总数，per_host 限制同一主机同时进行的请求数
+          取出的 URL 按主机排队，同时有空闲的总名额与主机名额时才发起请求，
+          某个主机已满时它排队的 URL 不占用总名额，其他主机的请求照常进行
+          最多预读 lookahead 个（默认 concurrency * 10）还没有发起的 URL
+        2.URL 可以是普通的可迭代对象（list、生成器），也可以是异步生成器
+        3.请求完成一个返回一个结果（BulkResult），结果的顺序与 URL 顺序无关
+          未被取走的结果最多缓存 concurrency 个，取得慢时会暂停发起新请求
+        4.连接失败（599）或服务端错误（5xx）时按 backoff * 2^n 秒的间隔重试 retries 次
+          最终失败的请求不会抛出异常，而是记录在 BulkResult.error 中
+
+    获取结果的方式：
+        1.在 async def 函数中使用 async for result in BulkFetcher(urls)
+        2.在 @gen.coroutine 协程函数中循环 yield fetcher.next()，返回 None 表示全部完成，之后再调用也返回 None
+        3.bulk_fetch 函数逐个回调每个结果，可以直接通过 run_sync 调用
+
+    注意：为了支持异步生成器，BulkFetcher 使用 Python 3.5+ 的 async def 原生协程
+
+    基准测试：python http_client.py --benchmark=bulk --count=100
+"""
+
+BulkResult = collections.namedtuple('BulkResult', ['url', 'response', 'error', 'attempts'])
+
+
+class BulkFetcher(object):
+
+    def __init__(self, urls, concurrency=10, per_host=2, retries=2, backoff=0.5, lookahead=None,
+                 http_client=None, **fetch_kwargs):
+        self.urls = urls
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.lookahead = lookahead or concurrency * 10
+        self.http_client = http_client
+        self.fetch_kwargs = fetch_kwargs
+        # 主机 -> 等待发起的 URL, 只包含还有 URL 在等待的主机
+        self._waiting = collections.OrderedDict()
+        # 主机 -> 正在进行的请求数
+        self._active = collections.Counter()
+        self._buffered = 0
+        self._running = 0
+        self._space = locks.Condition()
+        self._results = queues.Queue(maxsize=concurrency)
+        self._feeding = True
+        self._started = False
+        self._done = False
+        self._error = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        result = await self.next()
+        if result is None:
+            raise StopAsyncIteration
+        return result
+
+    async def next(self):
+        if self._done:
+            return None
+        if not self._started:
+            self._started = True
+            ioloop.IOLoop.current().spawn_callback(self._feed)
+        result = await self._results.get()
+        if result is None:
+            self._done = True
+            if self._error is not None:
+                # URL 序列本身抛出的异常
+                raise self._error
+        return result
+
+    async def _feed(self):
+        try:
+            if hasattr(self.urls, '__aiter__'):
+                async for url in self.urls:
+                    await self._submit(url)
+            else:
+                for url in self.urls:
+                    await self._submit(url)
+        except Exception as e:
+            self._error = e
+        self._feeding = False
+        await self._finish_if_done()
+
+    async def _submit(self, url):
+        # 预读的 URL 达到 lookahead 个时, 等待有 URL 发起之后再取下一个
+        while self._buffered >= self.lookahead:
+            await self._space.wait()
+        self._waiting.setdefault(urlsplit(url).netloc, collections.deque()).append(url)
+        self._buffered += 1
+        self._dispatch()
+
+    def _dispatch(self):
+        # 同时有空闲的并发名额与主机名额时才发起请求, 已满的主机不占用并发名额
+        for host in list(self._waiting):
+            if self._running >= self.concurrency:
+                break
+            urls = self._waiting[host]
+            while urls and self._running < self.concurrency and self._active[host] < self.per_host:
+                self._running += 1
+                self._active[host] += 1
+                self._buffered -= 1
+                ioloop.IOLoop.current().spawn_callback(self._fetch, urls.popleft(), host)
+            if not urls:
+                del self._waiting[host]
+            else:
+                # 还有 URL 在等待的主机排到最后, 各主机轮流发起请求
+                self._waiting.move_to_end(host)
+        self._space.notify_all()
+
+    async def _fetch(self, url, host):
+        result = await self._fetch_with_retries(url)
+        self._active[host] -= 1
+        if not self._active[host]:
+            del self._active[host]
+        self._dispatch()
+        # 结果被取走之前不释放并发名额，限制缓存的结果数量
+        await self._results.put(result)
+        self._running -= 1
+        self._dispatch()
+        await self._finish_if_done()
+
+    async def _finish_if_done(self):
+        if not self._feeding and self._running == 0 and self._buffered == 0:
+            await self._results.put(None)
+
+    async def _fetch_with_retries(self, url):
+        http_client = self.http_client or AsyncHTTPClient()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = await http_client.fetch(url, **self.fetch_kwargs)
+                return BulkResult(url, response, None, attempt)
+            except Exception as e:
+                code = getattr(e, 'code', 599)
+                if attempt > self.retries or not (code == 599 or code >= 500):
+                    return BulkResult(url, getattr(e, 'response', None), e, attempt)
+            delay = self.backoff * (2 ** (attempt - 1))
+            await gen.sleep(delay * random.uniform(0.5, 1.5))
+
+
+async def bulk_fetch(urls, callback, **kwargs):
+    async for result in BulkFetcher(urls, **kwargs):
+        callback(result)
+
+
+def handle_bulk_result(result):
+    if result.error:
+        print('%s failed after %d attempts: %s' % (result.url, result.attempts, result.error))
+    else:
+        print('%s %d bytes' % (result.url, len(result.response.body)))
+
+
+@gen.coroutine
+def async_visit_many_by_coroutine(urls):
+    fetcher = BulkFetcher(urls, concurrency=100, per_host=10)
+    while True:
+        result = yield fetcher.next()
+        if result is None:
+            break
+        handle_bulk_result(result)
+
+
+"""
+    Tornado 同步请求 - 复用连接的同步客户端
+
+    sync_visit 每次调用都会新建一个 HTTPClient，
+    而每个 HTTPClient 都会创建自己的 IOLoop 与异步客户端，在循环中调用时代价很高
+
+    SyncClient 在多次请求之间复用同一个 IOLoop 与异步客户端：
+        1.安装了 pycurl 时默认使用 CurlAsyncHTTPClient，请求之间复用 keep-alive 连接
+          （Tornado 自带的 SimpleAsyncHTTPClient 每个请求都会新建连接）
+        2.fetch 与 HTTPClient.fetch 用法相同
+        3.fetch_many 在内部使用 BulkFetcher 并发请求，按完成顺序返回 BulkResult 列表
+        4.支持 with 语句，退出时关闭 IOLoop 与连接
+
+    注意：
+        1.与 HTTPClient 一样，不能在正在运行的 IOLoop 中使用
+        2.fetch_many 使用 HTTPClient 的内部属性 _io_loop 与 _async_client，
+          Tornado 5.0 ~ 6.x 的 HTTPClient 都有这两个属性，升级 Tornado 时需要确认
+
+    基准测试：python http_client.py --benchmark=sync --count=1000
+    在另一个线程中启动只有 "/" 的本地服务，依次用各种方式请求 --count 次，
+    没有安装 pycurl 时跳过 curl 一项，fetch_many 也改用 SimpleAsyncHTTPClient
+
+    本机结果（单核，服务端与客户端共用一个 CPU，安装了 pycurl，两次运行）：
+        sync_visit 方式（每次新建 HTTPClient）    约 1380 次/秒
+        SyncClient.fetch（simple，每次新建连接）  约 1850 次/秒
+        SyncClient.fetch（curl，复用连接）        约 2950 ~ 3300 次/秒
+        SyncClient.fetch_many（curl，并发 10）    约 4100 ~ 4200 次/秒
+"""
+
+
+class SyncClient(HTTPClient):
+
+    def __init__(self, async_client_class=None, **kwargs):
+        if async_client_class is None and CurlAsyncHTTPClient is not None:
+            async_client_class = CurlAsyncHTTPClient
+        super(SyncClient, self).__init__(async_client_class, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def fetch_many(self, urls, concurrency=10, per_host=10, **kwargs):
+        results = []
+
+        # _io_loop 与 _async_client 是 HTTPClient 的内部属性（Tornado 5.0 ~ 6.x）, 升级 Tornado 时需要确认
+        async def collect():
+            fetcher = BulkFetcher(urls, concurrency=concurrency, per_host=per_host,
+                                  http_client=self._async_client, **kwargs)
+            async for result in fetcher:
+                results.append(result)
+
+        self._io_loop.run_sync(collect)
+        return results
+
+
+def start_local_server(ports=1):
+    # 在另一个线程中运行本地服务, 返回 (IOLoop, 端口列表)
+    # "/" 立即返回, "/slow" 等待 0.2 秒后返回
+    import threading
+    import tornado.web
+    import tornado.httpserver
+    from tornado import testing
+
+    class HelloHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.write('Hello world!')
+
+    class SlowHandler(tornado.web.RequestHandler):
+        async def get(self):
+            await gen.sleep(0.2)
+            self.write('Hello world!')
+
+    sockets = [testing.bind_unused_port() for _ in range(ports)]
+    started = threading.Event()
+    server_loop = []
+
+    def serve():
+        io_loop = ioloop.IOLoop()
+        io_loop.make_current()
+        app = tornado.web.Application([('/', HelloHandler), ('/slow', SlowHandler)],
+                                      log_function=lambda handler: None)
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets([sock for sock, _ in sockets])
+        server_loop.append(io_loop)
+        started.set()
+        io_loop.start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    started.wait()
+    return server_loop[0], [port for _, port in sockets]
+
+
+def sync_benchmark(count=1000):
+    import time
+    from tornado.simple_httpclient import SimpleAsyncHTTPClient
+
+    server_loop, (port,) = start_local_server()
+    url = 'http://127.0.0.1:%d/' % port
+
+    def report(name, func):
+        begin = time.time()
+        func()
+        print('%-40s %6.0f req/sec' % (name, count / (time.time() - begin)))
+
+    def new_client_per_call():
+        for _ in range(count):
+            HTTPClient().fetch(url)
+
+    def reuse_client(async_client_class):
+        def run():
+            with SyncClient(async_client_class) as client:
+                for _ in range(count):
+                    client.fetch(url)
+        return run
+
+    def fetch_many():
+        with SyncClient() as client:
+            client.fetch_many([url] * count, concurrency=10)
+
+    report('HTTPClient per call', new_client_per_call)
+    report('SyncClient.fetch (simple)', reuse_client(SimpleAsyncHTTPClient))
+    if CurlAsyncHTTPClient is not None:
+        report('SyncClient.fetch (curl)', reuse_client(CurlAsyncHTTPClient))
+    report('SyncClient.fetch_many (concurrency 10)', fetch_many)
+    server_loop.add_callback(server_loop.stop)
+
+
+def bulk_benchmark(count=100, concurrency=10, per_host=2):
+    # BulkFetcher 同时请求一个慢主机（每个请求 0.2 秒）与一个快主机, 各 count 个 URL,
+    # 输出快主机第一个结果到达的时间与全部完成的时间
+    import time
+    from tornado.simple_httpclient import SimpleAsyncHTTPClient
+
+    server_loop, (slow_port, fast_port) = start_local_server(ports=2)
+    urls = ['http://127.0.0.1:%d/slow' % slow_port] * count + ['http://127.0.0.1:%d/' % fast_port] * count
+
+    async def run():
+        http_client = SimpleAsyncHTTPClient(force_instance=True, max_clients=concurrency)
+        begin = time.time()
+        first_fast = None
+        async for result in BulkFetcher(urls, concurrency=concurrency, per_host=per_host, http_client=http_client):
+            if first_fast is None and result.url.endswith(':%d/' % fast_port):
+                first_fast = time.time() - begin
+        http_client.close()
+        print('BulkFetcher %d slow + %d fast URLs (concurrency %d, per_host %d): '
+              'first fast result %.3f s, all done %.2f s' % (count, count, concurrency, per_host,
+                                                              first_fast, time.time() - begin))
+
+    ioloop.IOLoop.current().run_sync(run)
+    server_loop.add_callback(server_loop.stop)
+
+
+if __name__ == '__main__':
+    # with SyncClient() as client:
+    #     for url in ['http://httpbin.org/ip', 'http://httpbin.org/ip']:
+    #         print(client.fetch(url).body)
+    #     for result in client.fetch_many(['http://httpbin.org/ip'] * 10):
+    #         print(result.response.body)
+    # urls = ('http://127.0.0.1:8888/number/%d' % i for i in range(10000))
+    # io_loop = ioloop.IOLoop.current()
+    # io_loop.run_sync(lambda: bulk_fetch(urls, handle_bulk_result, concurrency=100, per_host=10))
+    # io_loop.run_sync(lambda: async_visit_many_by_coroutine(urls))
+    from tornado.options import define, options, parse_command_line
+    define(name='benchmark', default='sync', help='Benchmark to run: sync (SyncClient) or bulk (BulkFetcher)',
+           type=str)
+    define(name='count', default=1000, help='Requests per case', type=int)
+    parse_command_line()
+    if options.benchmark == 'bulk':
+        bulk_benchmark(count=options.count)
+    else:
+        sync_benchmark(count=options.count)
@@ -3,15 +3,32 @@
 # date: 2019/5/21
 
 import os
-import json
-import cgi
 import uuid
+import tempfile
 import tornado.web
 import tornado.gen
-import tornado.httpclient
 import tornado.ioloop
-import tornado.template
+import tornado.options
 from datetime import datetime
+from template_registry import TEMPLATE_REGISTRY, render_inline
+from template_stream import StreamingRenderMixin
+from render_cache import RenderCache, RenderCacheMixin
+from session_store import make_session_store
+from shared_counter import SharedCounter
+from upstream import SingleFlightFetcher, UpstreamPool
+from metrics import RequestMetrics
+from log_pipeline import LogPipeline
+from upload import StreamingUploadHandler, discard_sink
+from websocket_server import PubSubHub, PubSubHandler, PubSubStatsHandler
+from json_codec import JSONCodec, JSONMixin
+from compression import Compressor, CompressionMixin
+from conditional import ConditionalMixin
+import router
+from cookie_cache import SecureCookieCache
+from token_auth import TokenSigner
+from ioloop_monitor import LoopLagMonitor, LoopWatchdog
+from admission import AdmissionController, AdmissionMixin
+from offload import Offloader, OffloadMixin
 
 """
     tornado.options 模块可用于从命令行读取配置
@@ -22,6 +39,58 @@ from datetime import datetime
 from tornado.options import define, options
 
 define(name='port', default=8888, help='Run on this port', type=int)
+define(name='session_store', default='memory', help='Session store backend: memory or sqlite', type=str)
+define(name='session_db', default=os.path.join(tempfile.gettempdir(), 'tornado-sessions.db'),
+       help='SQLite session database path', type=str)
+define(name='session_ttl', default=24 * 3600, help='Session absolute lifetime (seconds)', type=int)
+define(name='session_idle_ttl', default=3600, help='Session idle lifetime (seconds)', type=int)
+define(name='session_max', default=1000000, help='Max number of stored sessions', type=int)
+define(name='upstream_url', default='http://httpbin.org/ip', help='Upstream URL of the proxy handlers', type=str)
+define(name='upstream_ttl', default=1.0, help='Upstream response cache TTL (seconds, 0 = off)', type=float)
+define(name='upstream_stale_ttl', default=5.0, help='Serve stale upstream responses while revalidating (seconds)',
+       type=float)
+define(name='upstream_client', default='auto', help='Upstream client implementation: auto, curl or simple', type=str)
+define(name='upstream_max_clients', default=100, help='Max concurrent upstream requests', type=int)
+define(name='upstream_max_per_host', default=20, help='Max concurrent upstream requests per host', type=int)
+define(name='upstream_queue_timeout', default=5.0, help='Max seconds an upstream request waits in queue',
+       type=float)
+define(name='upload_path', default=os.path.join(tempfile.gettempdir(), 'tornado-uploads'),
+       help='Directory of files saved by the streaming upload handler', type=str)
+define(name='json_impl', default='auto', help='JSON encoder implementation: auto, orjson or stdlib', type=str)
+define(name='compress', default=True, help='Compress template pages according to Accept-Encoding', type=bool)
+define(name='compress_min_size', default=1024, help='Minimum response size to compress (bytes)', type=int)
+define(name='cookie_cache_size', default=10000, help='Max number of cached verified session cookies (0 = off)',
+       type=int)
+define(name='auth_mode', default='session', help='User authentication: session (session store) or token (signed token)',
+       type=str)
+define(name='auth_token_ttl', default=24 * 3600, help='Lifetime of signed auth tokens (seconds)', type=int)
+define(name='cookie_secrets', default=[], help='Signing secrets, newest first (older ones only verify)',
+       type=str, multiple=True)
+define(name='admission', default=True, help='Shed load with 503 when the IOLoop is overloaded', type=bool)
+define(name='admission_max_lag', default=0.5, help='Max IOLoop lag (seconds) before shedding (0 = off)', type=float)
+define(name='admission_max_in_flight', default=1000, help='Max requests in flight before shedding (0 = off)',
+       type=int)
+define(name='admission_rate', default=0, help='Requests per second allowed per client IP (0 = off)', type=float)
+define(name='admission_burst', default=0, help='Burst size of the per client IP token bucket (0 = rate)', type=int)
+define(name='admission_max_keys', default=10000, help='Max number of tracked client IPs', type=int)
+define(name='loop_lag_interval', default=0.1, help='IOLoop lag sampling interval (seconds)', type=float)
+define(name='watchdog', default=True, help='Record stacks of callbacks blocking the IOLoop, served at /debug/blocking',
+       type=bool)
+define(name='watchdog_threshold', default=0.1, help='Record callbacks blocking the IOLoop longer than this (seconds)',
+       type=float)
+define(name='offload_threads', default=4, help='Threads for offloaded handler work (0 = run on the IOLoop)', type=int)
+define(name='offload_processes', default=0, help='Processes for offloaded GIL-bound work (0 = use the thread pool)',
+       type=int)
+define(name='offload_max_queue', default=100, help='Max offloaded tasks waiting per pool before returning 503',
+       type=int)
+define(name='pubsub_max_queue', default=256, help='Max queued WebSocket frames per subscriber', type=int)
+define(name='pubsub_overflow', default='drop', help='Slow subscriber policy: drop (oldest frames) or disconnect',
+       type=str)
+define(name='router', default='indexed', help='URL router: indexed or tornado (linear scan)', type=str)
+define(name='metrics', default=True, help='Record per-route request metrics, served at /metrics', type=bool)
+define(name='log_sync', default=False, help='Write handler logs synchronously instead of via the log pipeline',
+       type=bool)
+define(name='log_sample', default=1.0, help='Sample rate of handler logs', type=float)
 
 """
     - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
@@ -32,12 +101,12 @@ define(name='port', default=8888, help='Run on this port', type=int)
 """
 
 
-class MainHandler(tornado.web.RequestHandler):
+class MainHandler(AdmissionMixin, tornado.web.RequestHandler):
     def get(self, *args, **kwargs):
         self.write('Hello world!')
 
 
-class NowHandler(tornado.web.RequestHandler):
+class NowHandler(AdmissionMixin, tornado.web.RequestHandler):
     def get(self, *args, **kwargs):
         now_datetime = datetime.now()
         now = datetime.strftime(now_datetime, "%Y-%m-%d %H:%M:%S")
@@ -51,7 +120,14 @@ class NowHandler(tornado.web.RequestHandler):
 """
 
 
-class NumberHandler(tornado.web.RequestHandler):
+class NumberHandler(AdmissionMixin, ConditionalMixin, tornado.web.RequestHandler):
+
+    # 输出只由路由参数决定, 参考 "条件请求与缓存策略"
+    cache_control = 'public, max-age=3600'
+
+    def get_validator(self):
+        return self.path_args
+
     def get(self, number):
         self.write(number)
 
@@ -69,7 +145,7 @@ class NumberHandler(tornado.web.RequestHandler):
 """
 
 
-class NumberDefaultHandler(tornado.web.RequestHandler):
+class NumberDefaultHandler(AdmissionMixin, tornado.web.RequestHandler):
     def get(self, number):
         if len(number) == 0:
             number = 'Default'
@@ -83,11 +159,32 @@ class NumberDefaultHandler(tornado.web.RequestHandler):
 """
 
 
-class DateHandler(tornado.web.RequestHandler):
+class DateHandler(AdmissionMixin, ConditionalMixin, tornado.web.RequestHandler):
+
+    cache_control = 'public, max-age=3600'
+
+    def get_validator(self):
+        return self.path_args
+
     def get(self, year, month, day):
         self.write('%s 年 %s 月 %s 日' % (year, month, day))
 
 
+"""
+    路由解析 - 条件请求与缓存策略
+
+    内容只由输入决定的路由（NumberHandler、DateHandler 以及模板页面）继承 ConditionalMixin（参考 conditional.py）
+
+    要点：
+        1、get_validator 返回决定输出的输入：路由参数、查询参数以及 template_version（模板文件的修改时间摘要）
+        2、If-None-Match 命中时在 prepare 中直接返回 304，不执行 get，也不渲染模板
+        3、cache_control 类属性设置每个路由的 Cache-Control
+           NumberHandler、DateHandler 的输出不会变化，允许缓存一小时
+           模板页面使用 no-cache，浏览器每次都带上 Etag 验证，模板修改后立即生效
+        4、ConditionalMixin 排在 RenderCacheMixin 与 CompressionMixin 之前
+"""
+
+
 """
     - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
 
@@ -101,7 +198,7 @@ class DateHandler(tornado.web.RequestHandler):
 """
 
 
-class SomethingHandler(tornado.web.RequestHandler):
+class SomethingHandler(AdmissionMixin, tornado.web.RequestHandler):
 
     def initialize(self, something):
         self.something = something
@@ -118,19 +215,121 @@ class SomethingHandler(tornado.web.RequestHandler):
 """
 
 
-class BeforeAndAfterHandler(tornado.web.RequestHandler):
+class BeforeAndAfterHandler(AdmissionMixin, tornado.web.RequestHandler):
 
     def prepare(self):
-        print('"GET" prepare.')
+        self.settings['log_pipeline'].log('"GET" prepare.')
+        super(BeforeAndAfterHandler, self).prepare()
 
     def on_finish(self):
-        print('"GET" on finish.')
+        self.settings['log_pipeline'].log('"GET" on finish.')
+        super(BeforeAndAfterHandler, self).on_finish()
 
     def get(self):
-        print('In "GET" method.')
+        self.settings['log_pipeline'].log('In "GET" method.')
         self.write('GET')
 
 
+"""
+    接入点函数 - 日志管道
+
+    处理器中的日志通过 log_pipeline 写出（参考 log_pipeline.py），
+    IOLoop 线程只负责入队，由后台线程批量写入 stdout
+    输出日志管道的入队、写入、丢弃与采样计数
+"""
+
+
+class LogStatsHandler(JSONMixin, tornado.web.RequestHandler):
+
+    def get(self):
+        self.write(self.settings['log_pipeline'].stats())
+
+
+"""
+    接入点函数 - 请求指标
+
+    在 Application 层统计每个路由的请求数、状态码、进行中的请求数以及处理时间直方图（参考 metrics.py）
+    处理器不需要做任何修改，/metrics 以 Prometheus 文本格式输出
+    Cookie 校验缓存与令牌签名器的 stats() 也注册到 metrics 中，一起输出
+"""
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+
+    def get(self):
+        metrics = self.settings.get('metrics')
+        if metrics is None:
+            raise tornado.web.HTTPError(404)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.render())
+
+
+"""
+    接入点函数 - 准入控制
+
+    所有处理器共用一个 IOLoop 线程，过载时与其让所有请求一起变慢，不如让一部分请求立即失败（参考 admission.py）
+    处理器混入 AdmissionMixin 后，在 prepare 阶段检查 IOLoop 调度延迟、进行中的请求数以及客户端 IP 的令牌桶，
+    超出限制时直接返回 503（全局卸载）或者 429（按客户端限流）并带上 Retry-After
+
+    /metrics、/admission 等统计路由不做准入控制，过载时仍然可以观察服务状态
+    输出接受与拒绝的请求数以及当前的 IOLoop 调度延迟
+"""
+
+
+class AdmissionStatsHandler(JSONMixin, tornado.web.RequestHandler):
+
+    def get(self):
+        admission = self.settings.get('admission')
+        self.write({
+            'admission': admission.stats() if admission is not None else None,
+            'loop': self.settings['loop_monitor'].stats(),
+        })
+
+
+"""
+    接入点函数 - 阻塞调用检测
+
+    处理器中的同步计算（比如大模板渲染、大对象的 JSON 编码）会阻塞 IOLoop，所有连接都要等待
+    LoopWatchdog（参考 ioloop_monitor.py）的后台线程发现 IOLoop 心跳超过阈值没有执行时，
+    取得 IOLoop 线程的调用栈并找到正在执行的处理器
+
+    /debug/blocking 输出最近的阻塞记录（最新的在前），包括阻塞时长、处理器、请求与调用栈
+    调用栈会暴露代码细节，只允许本机访问
+"""
+
+
+class BlockingCallsHandler(JSONMixin, tornado.web.RequestHandler):
+
+    def get(self):
+        if self.request.remote_ip not in ('127.0.0.1', '::1'):
+            raise tornado.web.HTTPError(403)
+        monitor = self.settings['loop_monitor']
+        if not isinstance(monitor, LoopWatchdog):
+            raise tornado.web.HTTPError(404)
+        self.write({
+            'stats': monitor.stats(),
+            'offenders': monitor.recent(),
+        })
+
+
+"""
+    接入点函数 - 计算任务卸载
+
+    处理器混入 OffloadMixin 后，可以用 yield self.offload(fn, *args) 把同步计算交给线程池或进程池（参考 offload.py）
+    InputCatchReqHandler 的 JSON 编码（只有输出超过 offload_min_bytes 时）与 ControlFlowTempHandler 的模板渲染使用了这种方式
+    池中排队的任务超过 --offload_max_queue 时返回 503
+
+    输出每个池的工作线程（进程）数、排队任务数、完成与拒绝的任务数以及平均排队与执行时间
+"""
+
+
+class OffloadStatsHandler(JSONMixin, tornado.web.RequestHandler):
+
+    def get(self):
+        pools = self.settings['offload_pools']
+        self.write({kind: pool.stats() if pool is not None else None for kind, pool in pools.items()})
+
+
 """
     - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
 
@@ -149,7 +348,7 @@ class BeforeAndAfterHandler(tornado.web.RequestHandler):
 """
 
 
-class InputCatchArgHandler(tornado.web.RequestHandler):
+class InputCatchArgHandler(AdmissionMixin, tornado.web.RequestHandler):
 
     def get(self):
         arg = self.get_argument(name='arg')
@@ -173,8 +372,12 @@ class InputCatchArgHandler(tornado.web.RequestHandler):
 """
 
 
-class InputCatchReqHandler(tornado.web.RequestHandler):
+class InputCatchReqHandler(AdmissionMixin, OffloadMixin, JSONMixin, tornado.web.RequestHandler):
 
+    # 小于该字节数的输出直接编码, 编码只要几十微秒, 交给线程池的往返开销反而更大
+    offload_min_bytes = 64 * 1024
+
+    @tornado.gen.coroutine
     def get(self):
         remote_ip = self.request.remote_ip
         host = self.request.host
@@ -201,11 +404,26 @@ class InputCatchReqHandler(tornado.web.RequestHandler):
         http_req_info.setdefault('arguments', str(arguments))
         http_req_info.setdefault('files', str(files))
         http_req_info.setdefault('cookies', str(cookies))
-        http_req_info_json = json.dumps(http_req_info, indent=True, ensure_ascii=False)
-        print(type(self.request))
-        print(http_req_info_json)
-        html = cgi.escape(http_req_info_json)
-        self.write(html)
+        self.settings['log_pipeline'].log('%s', type(self.request))
+        self.settings['log_pipeline'].log('%s', http_req_info)
+        # 以 JSON 格式输出, 请求带有 ?pretty=1 时缩进
+        # 请求很大时编码耗时较长, 在线程池中编码, 不阻塞 IOLoop（参考 offload.py）
+        if sum(len(value) for value in http_req_info.values()) < self.offload_min_bytes:
+            data = self.json_codec.dumps(http_req_info, self.json_pretty())
+        else:
+            data = yield self.offload(self.json_codec.dumps, http_req_info, self.json_pretty())
+        self.write_json_bytes(data)
+
+
+"""
+    输入捕获 - 流式上传
+
+    InputCatchReqHandler 中的 self.request.body 与 self.request.files 要求 Tornado 先把整个请求体读入内存
+    StreamingUploadHandler（参考 upload.py）边接收边写入 sink 并计算校验和，内存占用与上传大小无关
+    每个路由可以设置各自的最大上传字节数与 sink
+
+    curl -T big.iso http://localhost:8888/upload
+"""
 
 
 """
@@ -250,7 +468,7 @@ class InputCatchReqHandler(tornado.web.RequestHandler):
 """
 
 
-class OutputResHandler(tornado.web.RequestHandler):
+class OutputResHandler(AdmissionMixin, tornado.web.RequestHandler):
 
     def get(self):
         self.set_header(name='CUSTOM-HEADERS-BE-CLEAR', value='invisible')
@@ -274,7 +492,7 @@ class OutputResHandler(tornado.web.RequestHandler):
 """
 
 
-class ErrorBackHandler(tornado.web.RequestHandler):
+class ErrorBackHandler(AdmissionMixin, tornado.web.RequestHandler):
 
     def get(self):
         greeting = self.get_argument('greeting', 'Hi')
@@ -298,7 +516,7 @@ class ErrorBackHandler(tornado.web.RequestHandler):
 """
 
 
-class AsyncHandler(tornado.web.RequestHandler):
+class AsyncHandler(AdmissionMixin, tornado.web.RequestHandler):
 
     @tornado.web.asynchronous
     def get(self):
@@ -306,13 +524,14 @@ class AsyncHandler(tornado.web.RequestHandler):
         self.finish()
 
 
-class AsyncSSRHandler(tornado.web.RequestHandler):
+class AsyncSSRHandler(AdmissionMixin, tornado.web.RequestHandler):
     # 以网站转发为例
+    # 上游请求经过 upstream_fetcher 合并与缓存（参考 upstream.py）, 上游地址由 upstream_url 参数指定
 
     @tornado.web.asynchronous
     def get(self):
-        http = tornado.httpclient.AsyncHTTPClient()
-        http.fetch('http://httpbin.org/ip', callback=self.on_response)
+        fetcher = self.settings['upstream_fetcher']
+        fetcher.fetch(self.settings['upstream_url'], callback=self.on_response)
 
     def on_response(self, response):
         if response.error:
@@ -337,15 +556,34 @@ class AsyncSSRHandler(tornado.web.RequestHandler):
 """
 
 
-class CoroutineHandler(tornado.web.RequestHandler):
+class CoroutineHandler(AdmissionMixin, tornado.web.RequestHandler):
 
     @tornado.gen.coroutine
     def get(self):
-        http = tornado.httpclient.AsyncHTTPClient()
-        response = yield http.fetch('http://httpbin.org/ip')
+        fetcher = self.settings['upstream_fetcher']
+        response = yield fetcher.fetch(self.settings['upstream_url'])
+        # upstream_fetcher 不会抛出异常, 上游出错时通过 rethrow 抛出
+        response.rethrow()
         self.write(response.body)
 
 
+"""
+    网站转发 - 上游请求统计
+
+    输出 upstream_fetcher 的命中、合并以及实际发起请求的次数
+    以及 upstream_pool 的并发、排队与排队超时情况
+"""
+
+
+class UpstreamStatsHandler(JSONMixin, tornado.web.RequestHandler):
+
+    def get(self):
+        self.write({
+            'fetcher': self.settings['upstream_fetcher'].stats(),
+            'pool': self.settings['upstream_pool'].stats(),
+        })
+
+
 """
     - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
 
@@ -364,21 +602,22 @@ class CoroutineHandler(tornado.web.RequestHandler):
    注意：RequestHandler.get_cookie 返回类型是 bytes 不是 str
 """
 
-SESSION_ID = 0
-REQUEST_COUNT = 0
+# 会话 ID 与请求计数保存在跨进程共享内存中（参考 shared_counter.py）
+# 多进程部署时所有工作进程共用同一个计数, 会话 ID 不会重复
+# 计数器必须在 fork 之前创建, 因此在模块导入时创建
+SESSION_ID = SharedCounter()
+REQUEST_COUNT = SharedCounter()
 
 
-class AuthCookiesHandler(tornado.web.RequestHandler):
+class AuthCookiesHandler(AdmissionMixin, tornado.web.RequestHandler):
 
     def get(self):
-        global SESSION_ID
-        global REQUEST_COUNT
-        REQUEST_COUNT += 1
+        request_count = REQUEST_COUNT.increment()
         if not self.get_cookie('session'):
-            SESSION_ID += 1
-            self.set_cookie('session', str(SESSION_ID))
+            session_id = SESSION_ID.increment()
+            self.set_cookie('session', str(session_id))
             self.write('Session ID get new one.')
-        elif REQUEST_COUNT % 3 == 0:
+        elif request_count % 3 == 0:
             self.clear_cookie('session')
             self.write('Session ID clear.')
         else:
@@ -397,22 +636,22 @@ class AuthCookiesHandler(tornado.web.RequestHandler):
         1.tornado.web.Application 对象初始化时需要 cookie_secret 参数，该参数作为 Cookies 加密的密钥
         2.读取 Cookies 时，使用 RequestHandler.get_secure_cookie 代替 RequestHandler.get_cookie
         3.写入 Cookies 时，使用 RequestHandler.set_secure_cookie 代替 RequestHandler.set_cookie
+        4.密钥以列表形式配置（--cookie_secrets），第一个密钥用于签名，其余的旧密钥只用于校验签名令牌，
+          轮换密钥时不会使已登录用户的令牌立即失效（参考 token_auth.py）
 
 """
-COOKIES_SECRET = 'SALT'
+COOKIES_SECRETS = ['SALT']
 
 
-class AuthSecretCookiesHandler(tornado.web.RequestHandler):
+class AuthSecretCookiesHandler(AdmissionMixin, tornado.web.RequestHandler):
 
     def get(self):
-        global SESSION_ID
-        global REQUEST_COUNT
-        REQUEST_COUNT += 1
+        request_count = REQUEST_COUNT.increment()
         if not self.get_secure_cookie('session'):
-            SESSION_ID += 1
-            self.set_secure_cookie('session', str(SESSION_ID))
+            session_id = SESSION_ID.increment()
+            self.set_secure_cookie('session', str(session_id))
             self.write('Session ID get new one.')
-        elif REQUEST_COUNT % 3 == 0:
+        elif request_count % 3 == 0:
             self.clear_cookie('session')
             self.write('Session ID clear.')
         else:
@@ -425,22 +664,37 @@ class AuthSecretCookiesHandler(tornado.web.RequestHandler):
     
 """
 
-# 存储已进行身份认证的用户 UUID 映射关系
+# 已进行身份认证的用户 UUID 映射关系保存在会话存储中（tornado.web.Application 的 session_store 参数）
 # 这些 UUID 必须与 Cookies 关联, 才能够标识请求的认证状态
-SESSION_MAP = dict()
+# 会话存储的实现可参考 session_store.py（进程内存储或多进程共享的 SQLite 存储）
+#
+# --auth_mode=token 时不使用会话存储, 用户身份写在签名令牌中（tornado.web.Application 的 token_signer 参数）
+# 任何持有相同密钥的进程或机器都可以独立校验令牌, 不需要任何查找（参考 token_auth.py）
+# 令牌放在 auth_token Cookie 中, 也可以通过 Authorization: Bearer <令牌> 请求头传递
 
 
 # 继承 RequestHandler 并重写 get_current_user 方法
-class BaseHandler(tornado.web.RequestHandler):
+class BaseHandler(AdmissionMixin, tornado.web.RequestHandler):
 
     def get_current_user(self):
         # get_current_user 根据 Cookies 获取当前会话对应的用户身份
-        global SESSION_MAP
-        session_id = self.get_secure_cookie('session_id')
-        session_id = session_id.decode()
-        current_user = SESSION_MAP.get(session_id)
+        # 同一个请求中 current_user 只会调用一次 get_current_user
+        # 校验过的 Cookie 由 cookie_cache 缓存, 不再重复计算签名（参考 cookie_cache.py）
+        if self.settings['auth_mode'] == 'token':
+            return self.settings['token_signer'].verify(self.get_auth_token())
+        session_id = self.settings['cookie_cache'].get_secure_cookie(self, 'session_id')
+        if session_id is None:
+            # 没有 Cookie 或者 Cookie 校验失败
+            return None
+        current_user = self.settings['session_store'].get(session_id)
         return current_user
 
+    def get_auth_token(self):
+        authorization = self.request.headers.get('Authorization', '')
+        if authorization.startswith('Bearer '):
+            return authorization[7:].strip()
+        return self.get_cookie('auth_token')
+
 
 # 模拟需要用户身份认证才能访问的页面
 class NeedAuthHandler(BaseHandler):
@@ -481,13 +735,16 @@ class LoginHandler(BaseHandler):
     # 认证成功则生成当前用户的 UUID 并保存, 还需要与 Cookies 关联, 然后再跳转到制定页面
     # 认证失败则依然跳转到 login_url
     def post(self):
-        global SESSION_MAP
         name = self.get_argument('name')
         if len(name) <= 3:
             self.redirect('/login')
+        elif self.settings['auth_mode'] == 'token':
+            signer = self.settings['token_signer']
+            self.set_cookie('auth_token', signer.issue(name), expires_days=signer.ttl / 86400.0, httponly=True)
+            self.redirect('/need-auth')
         else:
             session_id = str(uuid.uuid1())
-            SESSION_MAP[session_id] = name
+            self.settings['session_store'].set(session_id, name)
             self.set_secure_cookie('session_id', session_id)
             self.redirect('/need-auth')
 
@@ -509,66 +766,80 @@ class LoginHandler(BaseHandler):
 """
 
 
-class IndexHandler(tornado.web.RequestHandler):
+class IndexHandler(AdmissionMixin, tornado.web.RequestHandler):
 
     def get(self):
         self.render(template_name='index.html')
 
 
-class PoemIndexHandler(tornado.web.RequestHandler):
+class PoemIndexHandler(AdmissionMixin, ConditionalMixin, RenderCacheMixin, CompressionMixin,
+                       tornado.web.RequestHandler):
+
+    # 只有两种输出, 缓存渲染结果与压缩结果
+    render_cache = RenderCache()
+    compress_cacheable = True
+    # 模板页面每次都要向服务端验证 Etag, 模板修改后立即生效
+    cache_control = 'no-cache'
+
+    def get_validator(self):
+        return self.get_argument('number', '1'), self.template_version('poem-index.html')
 
     def get(self):
         number = self.get_argument('number', '1')
         if int(number) == 1:
-            self.render(template_name='poem-index.html',
-                        route='/poem-page',
-                        number=1)
+            self.cached_render(template_name='poem-index.html',
+                               route='/poem-page',
+                               number=1)
         else:
-            self.render(template_name='poem-index.html',
-                        route='/poem-page-temp',
-                        number=2)
+            self.cached_render(template_name='poem-index.html',
+                               route='/poem-page-temp',
+                               number=2)
 
 
-class PoemPageHandler(tornado.web.RequestHandler):
+class PoemPageHandler(AdmissionMixin, RenderCacheMixin, tornado.web.RequestHandler):
+
+    # 渲染结果只由四个表单参数决定，以参数为键缓存
+    render_cache = RenderCache(max_bytes=1024 * 1024, ttl=300)
 
     def post(self):
         noun1 = self.get_argument('noun1')
         noun2 = self.get_argument('noun2')
         verb = self.get_argument('verb')
         noun3 = self.get_argument('noun3')
-        self.render('poem-page.html',
-                    roads=noun1,
-                    wood=noun2,
-                    made=verb,
-                    difference=noun3)
-
-
-class PoemPageTempHandler(tornado.web.RequestHandler):
+        self.cached_render('poem-page.html',
+                           roads=noun1,
+                           wood=noun2,
+                           made=verb,
+                           difference=noun3)
+
+
+class PoemPageTempHandler(AdmissionMixin, tornado.web.RequestHandler):
+
+    html_temp = \
+    """
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <title>Poem Maker Pro 2</title>
+    </head>
+    <body>
+    <h1>Your poem 2</h1>
+    <p>
+        Two {{roads}} diverged in a {{wood}}, and I—<br>
+        I took the one less travelled by,<br>
+        And that has {{made}} all the {{difference}}.
+    </p>
+    </body>
+    </html>
+    """
 
     def post(self):
         noun1 = self.get_argument('noun1')
         noun2 = self.get_argument('noun2')
         verb = self.get_argument('verb')
         noun3 = self.get_argument('noun3')
-        html_temp = \
-        """
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-            <meta charset="UTF-8">
-            <title>Poem Maker Pro 2</title>
-        </head>
-        <body>
-        <h1>Your poem 2</h1>
-        <p>
-            Two {{roads}} diverged in a {{wood}}, and I—<br>
-            I took the one less travelled by,<br>
-            And that has {{made}} all the {{difference}}.
-        </p>
-        </body>
-        </html>
-        """
-        temp = tornado.template.Template(template_string=html_temp)
+        temp = TEMPLATE_REGISTRY.get(self.html_temp)
         content = temp.generate(roads=noun1,
                                 wood=noun2,
                                 made=verb,
@@ -583,26 +854,27 @@ class PoemPageTempHandler(tornado.web.RequestHandler):
 """
 
 
-class ExpressionTempHandler(tornado.web.RequestHandler):
+class ExpressionTempHandler(AdmissionMixin, tornado.web.RequestHandler):
+
+    html_temp = \
+    """
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <title>Expression</title>
+    </head>
+    <body>
+    <p>
+        {{ 1 + 2 }}<br>
+        {{ ', '.join([i for i in range(10)]) }}<br>
+    </p>
+    </body>
+    </html>
+    """
 
     def get(self):
-        html_temp = \
-        """
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-            <meta charset="UTF-8">
-            <title>Expression</title>
-        </head>
-        <body>
-        <p>
-            {{ 1 + 2 }}<br>
-            {{ ', '.join([i for i in range(10)]) }}<br>
-        </p>
-        </body>
-        </html>
-        """
-        temp = tornado.template.Template(template_string=html_temp)
+        temp = TEMPLATE_REGISTRY.get(self.html_temp)
         content = temp.generate()
         self.write(content)
 
@@ -612,34 +884,50 @@ class ExpressionTempHandler(tornado.web.RequestHandler):
     表单与模板 - 控制流语句
 
     语句块以 "{%" 开始 "%}" 结束
+
+    ?n= 指定列表长度（默认 10，最多 max_items），列表很长时渲染是纯 Python 计算，
+    声明 offload_pool = 'process' 在进程池中渲染（未配置进程池时使用线程池），不阻塞 IOLoop
+
+    ?stream=1 时流式渲染（参考 template_stream.py），边渲染边发送，
+    首字节时间与内存占用不再随列表长度增长
 """
 
 
-class ControlFlowTempHandler(tornado.web.RequestHandler):
+class ControlFlowTempHandler(AdmissionMixin, OffloadMixin, StreamingRenderMixin, tornado.web.RequestHandler):
+
+    offload_pool = 'process'
+    max_items = 1000000
+
+    html_temp = \
+    """
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <title>Control Flow</title>
+    </head>
+    <body>
+    <p>
+        <ul>
+            {% for index in index_list %}
+                <li>{{ index }}</li>
+            {% end %}
+        </ul>
+    </p>
+    </body>
+    </html>
+    """
 
+    @tornado.gen.coroutine
     def get(self):
-
-        html_temp = \
-        """
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-            <meta charset="UTF-8">
-            <title>Control Flow</title>
-        </head>
-        <body>
-        <p>
-            <ul>
-                {% for index in index_list %}
-                    <li>{{ index }}</li>
-                {% end %}
-            </ul>
-        </p>
-        </body>
-        </html>
-        """
-        temp = tornado.template.Template(template_string=html_temp)
-        content = temp.generate()
+        try:
+            n = min(int(self.get_argument('n', '10')), self.max_items)
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'n must be an integer')
+        if self.get_argument('stream', '0') not in ('', '0'):
+            yield self.render_stream(self.html_temp, index_list=range(n))
+            return
+        content = yield self.offload(render_inline, self.html_temp, index_list=range(n))
         self.write(content)
 
 
@@ -659,32 +947,32 @@ class ControlFlowTempHandler(tornado.web.RequestHandler):
 """
 
 
-class FunctionTempHandler(tornado.web.RequestHandler):
+class FunctionTempHandler(AdmissionMixin, tornado.web.RequestHandler):
+
+    html_temp = \
+    """
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <title>Function</title>
+    </head>
+    <body>
+        <p><a href="#">test_a</a> <br>{{ '<a href="#">test_a</a>' }}</p>
+        <br>
+        <p>http://127.0.0.1?q={{ url_escape('测试') }}</p>
+        <br>
+        <p>{{ json_encode(json_data) }}</p>
+        <br>
+        <p>{{ squeeze('Lots  of   Spaces    .') }}</p>
+        <br>
+        <p>{{ custom_func('Hi') }}</p>
+    </body>
+    </html>
+    """
 
     def get(self):
 
-        html_temp = \
-        """
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-            <meta charset="UTF-8">
-            <title>Function</title>
-        </head>
-        <body>
-            <p><a href="#">test_a</a> <br>{{ '<a href="#">test_a</a>' }}</p>
-            <br>
-            <p>http://127.0.0.1?q={{ url_escape('测试') }}</p>
-            <br>
-            <p>{{ json_encode(json_data) }}</p>
-            <br>
-            <p>{{ squeeze('Lots  of   Spaces    .') }}</p>
-            <br>
-            <p>{{ custom_func('Hi') }}</p>
-        </body>
-        </html>
-        """
-
         def custom_func(text):
             return text + '!!!'
 
@@ -693,12 +981,30 @@ class FunctionTempHandler(tornado.web.RequestHandler):
             'age': 20
         }
 
-        temp = tornado.template.Template(template_string=html_temp)
+        temp = TEMPLATE_REGISTRY.get(self.html_temp)
         content = temp.generate(custom_func=custom_func,
                                 json_data=json_data)
         self.write(content)
 
 
+"""
+
+    表单与模板 - 内联模板编译缓存
+
+    以上内联模板处理器都把模板字符串声明为类属性 html_temp
+    并通过 TEMPLATE_REGISTRY.get 获取编译好的 Template 对象，避免每次请求重新编译
+    服务启动时会从路由表中收集所有 html_temp 进行预编译
+
+    TemplateRegistryHandler 输出注册表的编译次数与命中次数
+"""
+
+
+class TemplateRegistryHandler(JSONMixin, tornado.web.RequestHandler):
+
+    def get(self):
+        self.write(TEMPLATE_REGISTRY.stats())
+
+
 """
 
     模板扩展 - 模板继承
@@ -713,14 +1019,25 @@ class FunctionTempHandler(tornado.web.RequestHandler):
 """
 
 
-class TempInheritHandler(tornado.web.RequestHandler):
+class TempInheritHandler(AdmissionMixin, ConditionalMixin, RenderCacheMixin, CompressionMixin, tornado.web.RequestHandler):
 
-    def get(self):
+    render_cache = RenderCache()
+    compress_cacheable = True
+    cache_control = 'no-cache'
+
+    def template_name(self):
         inherit = self.get_argument('inherit', '0')
         if inherit == '0':
-            self.render(template_name='inherit/block-page.html')
+            return 'inherit/block-page.html'
         else:
-            self.render(template_name='inherit/block-sub-page.html')
+            return 'inherit/block-sub-page.html'
+
+    def get_validator(self):
+        # template_version 包含了被继承的父模板
+        return self.template_version(self.template_name())
+
+    def get(self):
+        self.cached_render(template_name=self.template_name())
 
 
 """
@@ -745,99 +1062,320 @@ class UIModuleJS(tornado.web.UIModule):
         return '<script>alert("Hi")</script>'
 
 
-class UIModuleHandler(tornado.web.RequestHandler):
+class UIModuleHandler(AdmissionMixin, ConditionalMixin, RenderCacheMixin, CompressionMixin, tornado.web.RequestHandler):
+
+    render_cache = RenderCache()
+    compress_cacheable = True
+    cache_control = 'no-cache'
+
+    def get_validator(self):
+        return self.template_version('ui-module/js.html')
 
     def get(self):
-        self.render(template_name='ui-module/js.html')
+        self.cached_render(template_name='ui-module/js.html')
 
 
-if __name__ == '__main__':
-    # 路由解析
-    route_sheet = [
-        # 路由解析 - 固定字符串路径
-        ('/', MainHandler),
-        ('/now', NowHandler),
-        # 路由解析 - 参数字符串路径
-        ('/number/(\d+)', NumberHandler),
-        # 路由解析 - 带默认值的参数路径
-        ('/number-default/(\d*)', NumberDefaultHandler),
-        # 路由解析 - 多参数路径
-        ('/date/(\d{4})/(\d{1,2})/(\d{1,2})', DateHandler),
-
-        # 接入点函数 - 带参初始化
-        ('/something', SomethingHandler, {'something': 'Say something.'}),
-        # 接入点函数 - 请求处理前后
-        ('/before-and-after', BeforeAndAfterHandler),
-
-        # 输入捕获 - 解析参数
-        ('/input-catch-arg', InputCatchArgHandler),
-        # 输入捕获 - 解析 HTTP 请求
-        ('/input-catch-req', InputCatchReqHandler),
-
-        # 输出响应函数 - 解析参数
-        ('/output-res', OutputResHandler),
-
-        # 异常处理
-        ('/errorback/greet', ErrorBackHandler),
-
-        # 异步化处理
-        ('/async', AsyncHandler),
-        ('/async-ssr', AsyncSSRHandler),
-
-        # 协程化处理
-        ('/coroutine', CoroutineHandler),
-
-        # 身份验证 - Cookie 机制
-        ('/auth-cookies', AuthCookiesHandler),
-        # 身份验证 - 安全 Cookie 机制
-        ('/auth-sec-cookies', AuthSecretCookiesHandler),
-        # 身份验证 - 用户身份认证
-        ('/login', LoginHandler),
-        ('/need-auth', NeedAuthHandler),
-
-        # 表单与模板 - 渲染与填充
-        ('/index', IndexHandler),
-        ('/poem-index', PoemIndexHandler),
-        ('/poem-page', PoemPageHandler),
-        ('/poem-page-temp', PoemPageTempHandler),
-        # 表单与模板 - 填充表达式
-        ('/exp-temp', ExpressionTempHandler),
-        # 表单与模板 - 控制流语句
-        ('/ctlflow-temp', ControlFlowTempHandler),
-        # 表单与模板 - 模板函数
-        ('/func-temp', FunctionTempHandler),
-
-        # 模板扩展 - 模板继承
-        ('/inherit-temp', TempInheritHandler),
-        # 模板扩展 - UI 模块
-        ('/ui-module-temp', UIModuleHandler),
-
-    ]
-
-    # 模板文件目录
-    template_path = os.path.join(
-        os.path.dirname(__file__),
-        'templates'
-    )
+"""
+
+    模板扩展 - 渲染结果缓存
+
+    RenderCacheMixin 为 RequestHandler 提供可选的渲染结果缓存
+
+    要点：
+        1、处理器继承 RenderCacheMixin，并将 render_cache 类属性设置为 RenderCache 实例
+        2、使用 cached_render 代替 render，以 "模板名 + 参数" 作为缓存键
+        3、模板文件（包括继承的父模板）被修改后缓存自动失效
+
+    RenderCacheHandler 输出各个处理器的缓存统计
+"""
 
-    ui_modules_sheet = {
-        'JS_TEST': UIModuleJS,
-    }
 
-    app = tornado.web.Application(
-        # handlers 指明路由以及对应的 RequestHandler 子类
-        handlers=route_sheet,
+class RenderCacheHandler(JSONMixin, tornado.web.RequestHandler):
+
+    def get(self):
+        handlers = [PoemIndexHandler, PoemPageHandler, TempInheritHandler, UIModuleHandler]
+        self.write({h.__name__: h.render_cache.stats() for h in handlers})
+
+
+"""
+
+    模板扩展 - 响应压缩
+
+    模板页面根据 Accept-Encoding 压缩后输出（参考 compression.py）
+
+    要点：
+        1、处理器继承 CompressionMixin，与 RenderCacheMixin 一起使用时排在它的后面
+        2、输出内容可以缓存的处理器将 compress_cacheable 类属性设置为 True，重复的内容只压缩一次
+        3、小于 compress_min_size 字节的响应不压缩
+
+    CompressionHandler 输出压缩统计
+"""
+
+
+class CompressionHandler(JSONMixin, tornado.web.RequestHandler):
+
+    def get(self):
+        compressor = self.settings.get('compressor')
+        self.write(compressor.stats() if compressor is not None else {})
+
+
+"""
+
+    - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
+
+    WebSocket - 发布订阅
+
+    /ws 是 WebSocket 接入点，客户端通过 JSON 消息订阅主题、取消订阅以及发布消息（参考 websocket_server.py）
+
+    要点：
+        1、所有连接共用 tornado.web.Application 的 pubsub_hub 参数
+        2、每条广播消息只编码一次，同一个 WebSocket 帧写入所有订阅者的连接
+        3、每个连接的发送队列最多 --pubsub_max_queue 个帧，写得慢的订阅者按 --pubsub_overflow 策略丢弃旧帧或者断开
+
+    /pubsub-stats 输出主题数、连接数、投递与丢弃的消息数
+"""
+
+
+"""
+
+    - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
+
+    应用工厂
+    
+    make_app 根据路由表创建 tornado.web.Application 实例，默认关闭 debug
+    关键字参数会覆盖默认配置，比如本地开发时传入 debug=True
+    
+    多进程的生产环境启动方式参考 launcher.py
+
+"""
+
+# 路由解析
+route_sheet = [
+    # 路由解析 - 固定字符串路径
+    ('/', MainHandler),
+    ('/now', NowHandler),
+    # 路由解析 - 参数字符串路径
+    ('/number/(\d+)', NumberHandler),
+    # 路由解析 - 带默认值的参数路径
+    ('/number-default/(\d*)', NumberDefaultHandler),
+    # 路由解析 - 多参数路径
+    ('/date/(\d{4})/(\d{1,2})/(\d{1,2})', DateHandler),
+
+    # 接入点函数 - 带参初始化
+    ('/something', SomethingHandler, {'something': 'Say something.'}),
+    # 接入点函数 - 请求处理前后
+    ('/before-and-after', BeforeAndAfterHandler),
+    # 接入点函数 - 请求指标
+    ('/metrics', MetricsHandler),
+    # 准入控制统计
+    ('/admission', AdmissionStatsHandler),
+    # 阻塞 IOLoop 的调用
+    ('/debug/blocking', BlockingCallsHandler),
+    # 线程池与进程池的队列与耗时
+    ('/offload', OffloadStatsHandler),
+    # 接入点函数 - 日志管道
+    ('/log-stats', LogStatsHandler),
+
+    # 输入捕获 - 解析参数
+    ('/input-catch-arg', InputCatchArgHandler),
+    # 输入捕获 - 解析 HTTP 请求
+    ('/input-catch-req', InputCatchReqHandler),
+    # 输入捕获 - 流式上传, 保存到 upload_path 目录
+    ('/upload', StreamingUploadHandler, {'max_body_size': 2 * 1024 ** 3}),
+    # 输入捕获 - 流式上传, 只计算校验和
+    ('/upload-checksum', StreamingUploadHandler, {'max_body_size': 8 * 1024 ** 3, 'sink_factory': discard_sink}),
+
+    # 输出响应函数 - 解析参数
+    ('/output-res', OutputResHandler),
+
+    # 异常处理
+    ('/errorback/greet', ErrorBackHandler),
+
+    # 异步化处理
+    ('/async', AsyncHandler),
+    ('/async-ssr', AsyncSSRHandler),
+
+    # 协程化处理
+    ('/coroutine', CoroutineHandler),
+    # 网站转发 - 上游请求统计
+    ('/upstream-stats', UpstreamStatsHandler),
+
+    # 身份验证 - Cookie 机制
+    ('/auth-cookies', AuthCookiesHandler),
+    # 身份验证 - 安全 Cookie 机制
+    ('/auth-sec-cookies', AuthSecretCookiesHandler),
+    # 身份验证 - 用户身份认证
+    ('/login', LoginHandler),
+    ('/need-auth', NeedAuthHandler),
+
+    # 表单与模板 - 渲染与填充
+    ('/index', IndexHandler),
+    ('/poem-index', PoemIndexHandler),
+    ('/poem-page', PoemPageHandler),
+    ('/poem-page-temp', PoemPageTempHandler),
+    # 表单与模板 - 填充表达式
+    ('/exp-temp', ExpressionTempHandler),
+    # 表单与模板 - 控制流语句
+    ('/ctlflow-temp', ControlFlowTempHandler),
+    # 表单与模板 - 模板函数
+    ('/func-temp', FunctionTempHandler),
+    # 表单与模板 - 内联模板编译缓存
+    ('/temp-registry', TemplateRegistryHandler),
+
+    # 模板扩展 - 模板继承
+    ('/inherit-temp', TempInheritHandler),
+    # 模板扩展 - UI 模块
+    ('/ui-module-temp', UIModuleHandler),
+    # 模板扩展 - 渲染结果缓存
+    ('/render-cache', RenderCacheHandler),
+    # 模板扩展 - 响应压缩
+    ('/compression', CompressionHandler),
+
+    # WebSocket - 发布订阅
+    ('/ws', PubSubHandler),
+    ('/pubsub-stats', PubSubStatsHandler),
+
+]
+
+# 模板文件目录
+template_path = os.path.join(
+    os.path.dirname(__file__),
+    'templates'
+)
+
+ui_modules_sheet = {
+    'JS_TEST': UIModuleJS,
+}
+
+
+def make_app(**settings):
+    app_settings = dict(
         # template_path 指明模板文件所在目录
         template_path=template_path,
         # ui_modules 指明模板中 UI 模块 module 对应的 tornado.web.UIModule 子类
         ui_modules=ui_modules_sheet,
-        # cookie_secret 作为 Cookies 加密的密钥
-        cookie_secret=COOKIES_SECRET,
+        # cookie_secrets 签名密钥列表, 第一个作为 Cookies 加密的密钥 cookie_secret
+        cookie_secrets=options.cookie_secrets or COOKIES_SECRETS,
+        # auth_mode 用户身份认证方式: session 或者 token
+        auth_mode=options.auth_mode,
         # login_url 设置身份认证页面
         login_url='/login',
-        # debug 为 True 时, 修改代码会使服务器重启
-        debug=True
+        # upstream_url 网站转发的上游地址, 可指向本地服务用于测试
+        upstream_url=options.upstream_url,
+        # upload_path 流式上传的保存目录
+        upload_path=options.upload_path,
+        # debug 为 True 时, 修改代码会使服务器重启, 并且不缓存编译后的模板
+        debug=False,
     )
+    app_settings.update(settings)
+    app_settings.setdefault('cookie_secret', app_settings['cookie_secrets'][0])
+    if 'upstream_pool' not in app_settings:
+        # upstream_pool 所有转发类处理器共享的上游客户端
+        app_settings['upstream_pool'] = UpstreamPool(impl=options.upstream_client,
+                                                     max_clients=options.upstream_max_clients,
+                                                     max_per_host=options.upstream_max_per_host,
+                                                     queue_timeout=options.upstream_queue_timeout)
+    if 'upstream_fetcher' not in app_settings:
+        # upstream_fetcher 通过 upstream_pool 发起请求, 并合并与缓存相同的上游请求
+        app_settings['upstream_fetcher'] = SingleFlightFetcher(ttl=options.upstream_ttl,
+                                                               stale_ttl=options.upstream_stale_ttl,
+                                                               http_client=app_settings['upstream_pool'])
+    if 'session_store' not in app_settings:
+        # session_store 保存已认证用户的会话
+        app_settings['session_store'] = make_session_store(kind=options.session_store,
+                                                           path=options.session_db,
+                                                           ttl=options.session_ttl,
+                                                           idle_ttl=options.session_idle_ttl,
+                                                           max_entries=options.session_max)
+
+    # 预编译路由表中声明的所有内联模板
+    TEMPLATE_REGISTRY.warm(rule[1].html_temp for rule in route_sheet
+                           if hasattr(rule[1], 'html_temp'))
+
+    if 'cookie_cache' not in app_settings:
+        # cookie_cache 缓存校验通过的安全 Cookie, 与 cookie_secret 对应
+        app_settings['cookie_cache'] = SecureCookieCache(max_entries=options.cookie_cache_size)
+    if 'token_signer' not in app_settings:
+        # token_signer 签发与校验无状态的用户身份令牌
+        app_settings['token_signer'] = TokenSigner(app_settings['cookie_secrets'], ttl=options.auth_token_ttl)
+    if 'loop_monitor' not in app_settings:
+        # loop_monitor 测量 IOLoop 调度延迟, 并记录阻塞 IOLoop 的调用, 在 start_background_tasks 中启动
+        if options.watchdog:
+            app_settings['loop_monitor'] = LoopWatchdog(interval=options.loop_lag_interval,
+                                                        threshold=options.watchdog_threshold)
+        else:
+            app_settings['loop_monitor'] = LoopLagMonitor(interval=options.loop_lag_interval)
+    if 'admission' not in app_settings:
+        # admission 准入控制, IOLoop 过载时拒绝请求
+        app_settings['admission'] = AdmissionController(
+            rate=options.admission_rate,
+            burst=options.admission_burst or None,
+            max_keys=options.admission_max_keys,
+            max_lag=options.admission_max_lag,
+            max_in_flight=options.admission_max_in_flight,
+            lag_monitor=app_settings['loop_monitor']) if options.admission else None
+    if 'offload_pools' not in app_settings:
+        # offload_pools 处理器卸载同步计算的线程池与进程池, 进程池在第一次使用时创建
+        app_settings['offload_pools'] = {
+            'thread': Offloader('thread', workers=options.offload_threads,
+                                max_queue=options.offload_max_queue) if options.offload_threads > 0 else None,
+            'process': Offloader('process', workers=options.offload_processes,
+                                 max_queue=options.offload_max_queue) if options.offload_processes > 0 else None,
+        }
+    if 'compressor' not in app_settings:
+        # compressor 模板页面的响应压缩, 缓存可缓存页面的压缩结果
+        app_settings['compressor'] = Compressor(min_size=options.compress_min_size) if options.compress else None
+    if 'json_codec' not in app_settings:
+        # json_codec 处理器 write(dict) 时使用的 JSON 编码器
+        app_settings['json_codec'] = JSONCodec(impl=options.json_impl)
+    if 'pubsub_hub' not in app_settings:
+        # pubsub_hub WebSocket 发布订阅的主题与订阅者
+        app_settings['pubsub_hub'] = PubSubHub(max_queue=options.pubsub_max_queue, overflow=options.pubsub_overflow,
+                                               codec=app_settings['json_codec'])
+    if 'log_pipeline' not in app_settings:
+        # log_pipeline 处理器日志的写出管道, 不在 IOLoop 线程中写 stdout
+        app_settings['log_pipeline'] = LogPipeline(sample_rate=options.log_sample, background=not options.log_sync)
+    if 'metrics' not in app_settings:
+        # metrics 统计每个路由的请求指标, 并接管 log_function 输出访问日志
+        app_settings['metrics'] = RequestMetrics() if options.metrics else None
+    metrics = app_settings['metrics']
+    if metrics is not None and 'log_function' in app_settings:
+        metrics.log_function = app_settings['log_function']
+    if metrics is not None:
+        metrics.add_source('cookie_cache', app_settings['cookie_cache'].stats,
+                           counters=('hits', 'misses', 'failures', 'expirations', 'evictions'),
+                           gauges=('entries',), description='Secure cookie verification cache')
+        metrics.add_source('auth_token', app_settings['token_signer'].stats,
+                           counters=('issued', 'verified', 'failures', 'expirations'),
+                           description='Signed auth tokens')
+
+    # handlers 指明路由以及对应的 RequestHandler 子类
+    app = tornado.web.Application(handlers=route_sheet, **app_settings)
+    if options.router == 'indexed':
+        # 固定路径哈希查找, 正则路径按前缀索引, 参考 router.py
+        router.install(app)
+    if metrics is not None:
+        metrics.install(app)
+    return app
+
+
+def start_background_tasks(app, worker_id=None):
+    # 依赖 IOLoop 的后台任务, 多进程时必须在 fork 之后的子进程中调用, worker_id 为工作进程编号
+    # 定期清理过期会话, 在线程中执行, 不阻塞 IOLoop
+    # 多进程共用的存储（SQLite）只由第一个工作进程清理
+    session_store = app.settings['session_store']
+    if not session_store.shared or worker_id in (None, 0):
+        io_loop = tornado.ioloop.IOLoop.current()
+        tornado.ioloop.PeriodicCallback(lambda: io_loop.run_in_executor(None, session_store.purge),
+                                        60 * 1000).start()
+    # 测量 IOLoop 调度延迟, 供准入控制使用, 并检测阻塞 IOLoop 的调用
+    app.settings['loop_monitor'].start()
+
+
+if __name__ == '__main__':
+    tornado.options.parse_command_line()
+    app = make_app(debug=True)
+    start_background_tasks(app)
     app.listen(port=options.port)
     print('Tornado web server listen to %d port.' % options.port)
     tornado.ioloop.IOLoop.instance().start()
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import threading
+import traceback
+from collections import deque
+
+import tornado.web
+import tornado.ioloop
+
+"""
+    IOLoop 调度延迟监控
+
+    所有处理器共用一个 IOLoop 线程，某个回调执行时间过长或者就绪的回调太多时，
+    后面的回调都要排队等待，调度延迟（lag）就是一个回调实际执行的时间与预定时间之差
+
+    LoopLagMonitor 每隔 interval 秒用 call_later 安排一次采样回调：
+        1.采样回调执行时，实际时间与预定时间之差即为这一次的调度延迟
+        2.lag 为最近一次采样的延迟，max_lag 为启动以来的最大值，avg_lag 为指数移动平均
+        3.current_lag() 同时考虑还没有执行的采样回调：
+          预定时间已过而回调还在排队时，已经等待的时间也计入延迟，
+          所以在处理器中调用时不必等到下一次采样就能发现 IOLoop 已经过载
+
+    LoopWatchdog 在 LoopLagMonitor 的基础上检测阻塞 IOLoop 的调用：
+        1.采样回调就是 IOLoop 线程的心跳，一个后台线程每隔 check_interval 秒检查心跳，
+          心跳超过 threshold 秒没有按时执行，说明 IOLoop 线程正被某个回调阻塞
+        2.此时后台线程通过 sys._current_frames() 取得 IOLoop 线程当前的调用栈，
+          从栈中找到正在执行的 RequestHandler，记录处理器类名、请求与调用栈
+        3.心跳恢复时补上这一次阻塞的时长（心跳的延迟，比实际阻塞时长最多少 interval 秒），
+          最近 max_offenders 条记录供 /debug/blocking 路由使用
+
+    注意：
+        1.必须在运行 IOLoop 的线程中调用 start / stop，多进程时在 fork 之后的子进程中启动
+        2.未启动时所有延迟都为 0
+        3.阻塞的调用一直持有 GIL 时（比如一次耗时很长的 C 扩展调用），后台线程要等它释放 GIL 后才能取得调用栈，
+          此时记录的是释放之后的调用栈
+"""
+
+
+class LoopLagMonitor(object):
+
+    def __init__(self, interval=0.1, smoothing=0.2):
+        self.interval = interval
+        self.smoothing = smoothing
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.avg_lag = 0.0
+        self.samples = 0
+        self._io_loop = None
+        self._timeout = None
+        self._deadline = None
+
+    def start(self, io_loop=None):
+        if self._io_loop is not None:
+            return
+        self._io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self._schedule()
+
+    def stop(self):
+        if self._timeout is not None:
+            self._io_loop.remove_timeout(self._timeout)
+        self._io_loop = None
+        self._timeout = None
+        self._deadline = None
+
+    def _schedule(self):
+        self._deadline = self._io_loop.time() + self.interval
+        self._timeout = self._io_loop.call_at(self._deadline, self._sample)
+
+    def _sample(self):
+        lag = max(0.0, self._io_loop.time() - self._deadline)
+        self.lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.avg_lag += (lag - self.avg_lag) * self.smoothing
+        self.samples += 1
+        self._schedule()
+
+    def current_lag(self):
+        if self._io_loop is None:
+            return 0.0
+        return max(self.lag, self._io_loop.time() - self._deadline)
+
+    def stats(self):
+        return {
+            'running': self._io_loop is not None,
+            'interval_ms': self.interval * 1000,
+            'lag_ms': self.current_lag() * 1000,
+            'avg_lag_ms': self.avg_lag * 1000,
+            'max_lag_ms': self.max_lag * 1000,
+            'samples': self.samples,
+        }
+
+
+class LoopWatchdog(LoopLagMonitor):
+
+    def __init__(self, interval=0.1, threshold=0.1, check_interval=None, max_offenders=50, max_frames=30,
+                 smoothing=0.2):
+        super(LoopWatchdog, self).__init__(interval=interval, smoothing=smoothing)
+        self.threshold = threshold
+        self.check_interval = check_interval or min(interval, threshold) / 2.0
+        self.max_frames = max_frames
+        self.stalls = 0
+        self.offenders = deque(maxlen=max_offenders)
+        self._expected = None
+        self._stall = None
+        self._loop_thread = None
+        self._stopped = threading.Event()
+
+    def start(self, io_loop=None):
+        if self._io_loop is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._stopped.clear()
+        super(LoopWatchdog, self).start(io_loop)
+        thread = threading.Thread(target=self._watch, name='ioloop-watchdog')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        super(LoopWatchdog, self).stop()
+
+    def _schedule(self):
+        # 心跳的预定时间, 后台线程使用 time.monotonic() 与之比较
+        self._expected = time.monotonic() + self.interval
+        super(LoopWatchdog, self)._schedule()
+
+    def _sample(self):
+        stall = self._stall
+        if stall is not None:
+            # 阻塞结束, 补上总时长
+            stall['blocked_ms'] = max(stall['blocked_ms'], (time.monotonic() - self._expected) * 1000)
+            self._stall = None
+        super(LoopWatchdog, self)._sample()
+
+    def _watch(self):
+        while not self._stopped.wait(self.check_interval):
+            expected = self._expected
+            if expected is None or self._stall is not None:
+                continue
+            overdue = time.monotonic() - expected
+            if overdue > self.threshold:
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is not None:
+                    self._stall = self._record(frame, overdue)
+
+    def _record(self, frame, overdue):
+        handler = None
+        current = frame
+        while current is not None:
+            candidate = current.f_locals.get('self')
+            if isinstance(candidate, tornado.web.RequestHandler):
+                handler = candidate
+                break
+            current = current.f_back
+        stall = {
+            'time': time.time(),
+            'blocked_ms': overdue * 1000,
+            'handler': handler.__class__.__name__ if handler is not None else None,
+            'request': '%s %s' % (handler.request.method, handler.request.uri) if handler is not None else None,
+            'stack': traceback.format_list(traceback.extract_stack(frame, limit=self.max_frames)),
+        }
+        self.stalls += 1
+        self.offenders.append(stall)
+        return stall
+
+    def recent(self):
+        # 最近的阻塞记录, 最新的在前
+        return list(reversed(self.offenders))
+
+    def stats(self):
+        stats = super(LoopWatchdog, self).stats()
+        stats.update({
+            'threshold_ms': self.threshold * 1000,
+            'stalls': self.stalls,
+        })
+        return stats
+
+
+"""
+    IOLoop 调度延迟监控 - 演示
+
+    启动一个 IOLoop，每秒执行一次阻塞 --block 秒的回调（模拟在 IOLoop 中执行同步计算），
+    运行 --duration 秒后输出调度延迟统计与记录的阻塞调用栈
+
+    python ioloop_monitor.py --block=0.3 --duration=3
+"""
+
+
+def demo(block, duration):
+    io_loop = tornado.ioloop.IOLoop.current()
+    watchdog = LoopWatchdog()
+
+    def blocking_callback():
+        deadline = time.perf_counter() + block
+        while time.perf_counter() < deadline:
+            pass
+
+    tornado.ioloop.PeriodicCallback(blocking_callback, 1000).start()
+    watchdog.start()
+    io_loop.call_later(duration, io_loop.stop)
+    io_loop.start()
+    watchdog.stop()
+    print(watchdog.stats())
+    for stall in watchdog.recent()[-1:]:
+        print('blocked %.1f ms' % stall['blocked_ms'])
+        print(''.join(stall['stack'][-3:]))
+
+
+if __name__ == '__main__':
+    from tornado.options import define, options, parse_command_line
+    define(name='block', default=0.3, help='Seconds each blocking callback runs', type=float)
+    define(name='duration', default=3, help='Seconds to run', type=float)
+    parse_command_line()
+    demo(options.block, options.duration)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import errno
+import signal
+import logging
+
+import tornado.ioloop
+import tornado.netutil
+import tornado.process
+import tornado.httpserver
+from tornado.options import define, options, parse_command_line
+
+import http_server
+
+"""
+    多进程启动器
+
+    http_server.py 的 __main__ 以 debug 模式运行单个进程，只适合本地开发
+    生产环境由 launcher.py 启动：
+
+        python launcher.py --port=8888 --workers=4 --backlog=1024
+
+    要点：
+        1.默认工作进程数为 CPU 核数，每个工作进程运行独立的 IOLoop
+        2.默认在 fork 之前绑定监听端口，所有工作进程共享同一组套接字
+        3.--reuse_port 模式下每个工作进程在 fork 之后各自以 SO_REUSEPORT 绑定端口，
+          由内核在进程间分配连接（需要 Linux 3.9+）
+        4.主进程只负责监控，工作进程退出后自动重启；
+          若工作进程启动后很快退出，重启间隔按指数退避增加，避免频繁重启
+        5.主进程收到 SIGTERM / SIGINT 时通知所有工作进程退出
+        6.进程内会话存储（--session_store=memory）只属于一个工作进程，登录与之后的请求落到不同进程时会话就找不到了，
+          所以多个工作进程使用会话认证时改用所有进程共享的 SQLite 存储（--session_db）
+
+    注意：IOLoop 不能跨 fork 使用，fork 之前不能创建或启动 IOLoop
+"""
+
+define(name='workers', default=0, help='Number of worker processes (0 = CPU count)', type=int)
+define(name='backlog', default=128, help='Listen socket backlog', type=int)
+define(name='address', default='', help='Address to bind', type=str)
+define(name='reuse_port', default=False, help='Bind a SO_REUSEPORT socket in every worker', type=bool)
+define(name='xheaders', default=False, help='Trust X-Real-Ip / X-Forwarded-For headers', type=bool)
+
+# 工作进程运行超过该秒数后退出视为正常运行过，重启间隔复位
+MIN_UPTIME = 5.0
+MAX_RESTART_DELAY = 30.0
+
+logger = logging.getLogger('launcher')
+
+
+def bind_sockets(reuse_port=False):
+    return tornado.netutil.bind_sockets(options.port, address=options.address or None,
+                                        backlog=options.backlog, reuse_port=reuse_port)
+
+
+def run_worker(worker_id, sockets):
+    # 恢复默认信号处理，由主进程发送 SIGTERM 结束工作进程
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    if sockets is None:
+        sockets = bind_sockets(reuse_port=True)
+    app = http_server.make_app()
+    server = tornado.httpserver.HTTPServer(app, xheaders=options.xheaders)
+    server.add_sockets(sockets)
+    http_server.start_background_tasks(app, worker_id)
+    logger.info('Worker %d (pid %d) started.', worker_id, os.getpid())
+    tornado.ioloop.IOLoop.current().start()
+
+
+class Supervisor(object):
+
+    def __init__(self, workers, sockets):
+        self.workers = workers
+        self.sockets = sockets
+        self.children = {}
+        self.started = {}
+        self.delays = {}
+        self.stopping = False
+
+    def spawn(self, worker_id):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(worker_id, self.sockets)
+            except Exception:
+                logger.exception('Worker %d crashed.', worker_id)
+                os._exit(1)
+            os._exit(0)
+        self.children[pid] = worker_id
+        self.started[worker_id] = time.time()
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for worker_id in range(self.workers):
+            self.spawn(worker_id)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            worker_id = self.children.pop(pid, None)
+            if worker_id is None or self.stopping:
+                continue
+            self.restart(worker_id, pid, status)
+
+    def restart(self, worker_id, pid, status):
+        if os.WIFSIGNALED(status):
+            logger.warning('Worker %d (pid %d) killed by signal %d.', worker_id, pid, os.WTERMSIG(status))
+        else:
+            logger.warning('Worker %d (pid %d) exited with status %d.', worker_id, pid, os.WEXITSTATUS(status))
+        if time.time() - self.started[worker_id] < MIN_UPTIME:
+            delay = min(self.delays.get(worker_id, 0.5) * 2, MAX_RESTART_DELAY)
+        else:
+            delay = 0.5
+        self.delays[worker_id] = delay
+        time.sleep(delay)
+        if not self.stopping:
+            self.spawn(worker_id)
+
+
+def main():
+    parse_command_line()
+    workers = options.workers or tornado.process.cpu_count()
+    if workers > 1 and options.session_store == 'memory' and options.auth_mode == 'session':
+        logger.warning('The memory session store is per process, using the sqlite store (%s) for %d workers.',
+                       options.session_db, workers)
+        options.session_store = 'sqlite'
+    if options.reuse_port:
+        sockets = None
+    else:
+        sockets = bind_sockets()
+    logger.info('Tornado web server listen to %d port with %d workers (backlog %d%s).',
+                options.port, workers, options.backlog,
+                ', SO_REUSEPORT' if options.reuse_port else '')
+    Supervisor(workers, sockets).run()
+    logger.info('All workers exited.')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
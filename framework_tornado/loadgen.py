@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+import re
+import sys
+import time
+import logging
+import collections
+import multiprocessing
+
+import tornado.gen
+import tornado.ioloop
+from tornado.options import define, options, parse_command_line
+
+from http_client import AsyncHTTPClient, CurlAsyncHTTPClient
+from histogram import LatencyHistogram
+
+"""
+    HTTP 压测工具
+
+    基于 http_client.py 中的异步客户端，对 http_server.py 路由表中的任意路由进行压测
+    只允许访问本机地址
+
+    两种模式：
+        closed ：闭环模式，concurrency 个虚拟用户各自循环发送请求，上一个响应返回后才发送下一个
+        open   ：开环模式，按固定速率 rate（次/秒）发送请求，不等待响应
+                 延迟从计划发送时间开始计算，服务端变慢时排队时间也会计入延迟
+                 （避免 coordinated omission：闭环模式下服务端变慢会让压测工具自动降低发送速率，掩盖真实延迟）
+
+    延迟以微秒记录在 LatencyHistogram 中，输出吞吐量与 p50 / p90 / p99 / p99.9 延迟
+
+    用法：
+        python loadgen.py --list_routes
+        python loadgen.py --serve --route=/now --mode=closed --concurrency=50 --duration=10
+        python loadgen.py --port=8888 --route=/number/42 --mode=open --rate=2000 --duration=10
+        python loadgen.py --route=/poem-page --method=POST --body="noun1=a&noun2=b&verb=c&noun3=d"
+
+    --serve 在子进程中启动 http_server.make_app() 作为被测服务
+
+    注意：压测工具本身是单线程的 Python 进程，吞吐量上限取决于本机 CPU
+    压测工具与被测服务应尽量运行在不同的 CPU 核上
+"""
+
+LOCAL_HOSTS = ('127.0.0.1', 'localhost', '::1')
+
+LoadResult = collections.namedtuple('LoadResult', ['requests', 'errors', 'elapsed', 'histogram'])
+
+
+def match_route(path, route_sheet):
+    # 返回匹配该路径的路由规则, 与 Tornado 一样在规则末尾加上 "$"
+    path = path.split('?', 1)[0]
+    for rule in route_sheet:
+        pattern = rule[0]
+        if not pattern.endswith('$'):
+            pattern += '$'
+        if re.match(pattern, path):
+            return rule
+    return None
+
+
+class LoadGenerator(object):
+
+    def __init__(self, url, method='GET', body=None, headers=None, max_clients=1000, request_timeout=30):
+        self.url = url
+        self.method = method
+        self.body = body
+        self.headers = headers or {}
+        self.request_timeout = request_timeout
+        client_class = CurlAsyncHTTPClient or AsyncHTTPClient
+        self.http_client = client_class(force_instance=True, max_clients=max_clients)
+        self.histogram = LatencyHistogram()
+        self.requests = 0
+        self.errors = collections.Counter()
+
+    @tornado.gen.coroutine
+    def request(self, start=None):
+        # start 为计划发送时间（开环模式），默认为实际发送时间
+        if start is None:
+            start = time.perf_counter()
+        try:
+            response = yield self.http_client.fetch(self.url, method=self.method, body=self.body,
+                                                    headers=self.headers, follow_redirects=False,
+                                                    request_timeout=self.request_timeout,
+                                                    raise_error=False)
+            code = response.code
+        except Exception as e:
+            code = getattr(e, 'code', 599)
+        latency = time.perf_counter() - start
+        self.requests += 1
+        self.histogram.record(latency * 1e6)
+        if code >= 400:
+            self.errors[code] += 1
+
+    @tornado.gen.coroutine
+    def closed_loop(self, concurrency, duration):
+        deadline = time.perf_counter() + duration
+
+        @tornado.gen.coroutine
+        def user():
+            while time.perf_counter() < deadline:
+                yield self.request()
+
+        begin = time.perf_counter()
+        yield [user() for _ in range(concurrency)]
+        raise tornado.gen.Return(self.result(time.perf_counter() - begin))
+
+    @tornado.gen.coroutine
+    def open_loop(self, rate, duration):
+        interval = 1.0 / rate
+        begin = time.perf_counter()
+        deadline = begin + duration
+        scheduled = begin
+        pending = []
+        while scheduled < deadline:
+            now = time.perf_counter()
+            while scheduled <= now and scheduled < deadline:
+                pending.append(self.request(start=scheduled))
+                scheduled += interval
+            if len(pending) > 1000:
+                pending = [future for future in pending if not future.done()]
+            yield tornado.gen.sleep(max(0.0, scheduled - time.perf_counter()))
+        yield pending
+        raise tornado.gen.Return(self.result(time.perf_counter() - begin))
+
+    def result(self, elapsed):
+        return LoadResult(self.requests, sum(self.errors.values()), elapsed, self.histogram)
+
+    def close(self):
+        self.http_client.close()
+
+
+def print_result(name, result, errors=None):
+    summary = result.histogram.summary()
+    print('%s: %d requests in %.2fs, %.0f req/sec, %d errors%s' % (
+        name, result.requests, result.elapsed, result.requests / result.elapsed, result.errors,
+        ' %s' % dict(errors) if errors else ''))
+    print('  latency(ms)  mean %.2f  p50 %.2f  p90 %.2f  p99 %.2f  p99.9 %.2f  max %.2f' % (
+        summary['mean'] / 1000.0, summary['p50'] / 1000.0, summary['p90'] / 1000.0,
+        summary['p99'] / 1000.0, summary['p99.9'] / 1000.0, summary['max'] / 1000.0))
+
+
+def serve(port, ready):
+    # 子进程中运行被测服务
+    # fork 时父进程可能已经运行过 IOLoop, 继承下来的 IOLoop 与父进程共用同一个 epoll 实例,
+    # 两个进程会互相取走对方的事件, 子进程必须创建自己的 IOLoop
+    import http_server
+    tornado.ioloop.IOLoop.clear_current()
+    tornado.ioloop.IOLoop().make_current()
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
+    app = http_server.make_app()
+    app.listen(port, address='127.0.0.1')
+    http_server.start_background_tasks(app)
+    ready.set()
+    tornado.ioloop.IOLoop.current().start()
+
+
+def main():
+    import http_server
+    define(name='host', default='127.0.0.1', help='Target host (localhost only)', type=str)
+    define(name='route', default='/', help='Route path to request, e.g. /number/42', type=str)
+    define(name='method', default='GET', help='HTTP method', type=str)
+    define(name='body', default=None, help='Request body (form encoded)', type=str)
+    define(name='mode', default='closed', help='closed (fixed concurrency) or open (fixed rate)', type=str)
+    define(name='concurrency', default=50, help='Concurrent users in closed mode', type=int)
+    define(name='rate', default=1000, help='Requests per second in open mode', type=float)
+    define(name='duration', default=10, help='Test duration in seconds', type=float)
+    define(name='warmup', default=1, help='Warmup seconds before measuring', type=float)
+    define(name='serve', default=False, help='Start http_server in a child process', type=bool)
+    define(name='list_routes', default=False, help='List routes in http_server.route_sheet', type=bool)
+    parse_command_line()
+
+    if options.list_routes:
+        for rule in http_server.route_sheet:
+            print('%-40s %s' % (rule[0], rule[1].__name__))
+        return 0
+    if options.host not in LOCAL_HOSTS:
+        print('Refusing to load-test non-local host %s.' % options.host)
+        return 1
+    rule = match_route(options.route, http_server.route_sheet)
+    if rule is None:
+        print('Route %s does not match any rule in route_sheet, see --list_routes.' % options.route)
+        return 1
+    if options.mode not in ('closed', 'open'):
+        print('Unknown mode %s.' % options.mode)
+        return 1
+
+    server = None
+    if options.serve:
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=serve, args=(options.port, ready), daemon=True)
+        server.start()
+        ready.wait()
+
+    host = '[%s]' % options.host if ':' in options.host else options.host
+    url = 'http://%s:%d%s' % (host, options.port, options.route)
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'} if options.body else None
+    print('%s %s (%s), %s mode' % (options.method, url, rule[1].__name__, options.mode))
+
+    @tornado.gen.coroutine
+    def run():
+        if options.warmup > 0:
+            warmup = LoadGenerator(url, options.method, options.body, headers)
+            yield warmup.closed_loop(min(options.concurrency, 10), options.warmup)
+            warmup.close()
+        generator = LoadGenerator(url, options.method, options.body, headers,
+                                  max_clients=max(options.concurrency, 1000))
+        if options.mode == 'closed':
+            result = yield generator.closed_loop(options.concurrency, options.duration)
+            name = 'closed loop, %d users' % options.concurrency
+        else:
+            result = yield generator.open_loop(options.rate, options.duration)
+            name = 'open loop, %.0f req/sec target' % options.rate
+        print_result(name, result, generator.errors)
+        generator.close()
+
+    try:
+        tornado.ioloop.IOLoop.current().run_sync(run)
+    finally:
+        if server is not None:
+            server.terminate()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+
+"""
+    非阻塞日志管道
+
+    处理器中直接 print() 是在 IOLoop 线程中同步写 stdout，
+    stdout 是一个读得很慢的管道（比如被日志收集程序读取）时，管道写满后 print() 会阻塞，
+    整个 IOLoop 以及其它所有连接都会被卡住
+
+    LogPipeline 把写日志变成一次入队操作：
+        1.有界队列：log() 只做 put_nowait，队列满时丢弃这条日志并计数，绝不阻塞 IOLoop
+        2.后台线程：一个写线程从队列取出日志，格式化后写入 stream
+        3.批量写入：写线程一次取出最多 batch_size 条日志，合并为一次 write + flush
+        4.采样：sample_rate 为全局采样率，log() 的 sample 参数为单条日志的采样率，
+          例如每个请求都会输出的调试日志可以只保留 1%
+        5.延迟格式化：log(fmt, *args) 的格式化在写线程中完成，args 应当是不可变对象
+
+    计数器：
+        enqueued    ：入队的日志数
+        written     ：写入 stream 的日志数
+        dropped     ：队列满而丢弃的日志数
+        sampled_out ：被采样丢弃的日志数
+        batches     ：写入次数
+
+    background=False 时 log() 直接同步写入 stream（与 print() 相同），用于对比测试
+
+    注意：写线程在第一次 log() 时启动，fork 之后的子进程会重新启动自己的写线程
+"""
+
+_STOP = object()
+
+
+class LogPipeline(object):
+
+    def __init__(self, stream=None, max_queue=10000, batch_size=256, sample_rate=1.0, background=True):
+        self.stream = stream
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.sample_rate = sample_rate
+        self.background = background
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.batches = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def log(self, fmt, *args, sample=1.0):
+        rate = self.sample_rate * sample
+        if rate < 1.0 and random.random() >= rate:
+            self.sampled_out += 1
+            return
+        if not self.background:
+            self._write([(fmt, args)])
+            return
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait((fmt, args))
+        except queue.Full:
+            self.dropped += 1
+            return
+        self.enqueued += 1
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.max_queue)
+            self._thread = threading.Thread(target=self._run, name='log-pipeline', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            stop = batch[-1] is _STOP
+            if stop:
+                batch.pop()
+            if batch:
+                self._write(batch)
+            if stop:
+                return
+
+    def _write(self, batch):
+        lines = []
+        for fmt, args in batch:
+            try:
+                lines.append(fmt % args if args else fmt)
+            except Exception:
+                lines.append('%r %r' % (fmt, args))
+        lines.append('')
+        stream = self.stream or sys.stdout
+        try:
+            stream.write('\n'.join(lines))
+            stream.flush()
+        except (OSError, ValueError):
+            # stream 已关闭
+            self.dropped += len(batch)
+            return
+        self.written += len(batch)
+        self.batches += 1
+
+    def close(self, timeout=1.0):
+        # 写出队列中剩余的日志并停止写线程
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {
+            'enqueued': self.enqueued,
+            'written': self.written,
+            'dropped': self.dropped,
+            'sampled_out': self.sampled_out,
+            'batches': self.batches,
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+        }
+
+
+"""
+    非阻塞日志管道 - 慢管道下的基准测试
+
+    把 stdout 换成一个读得很慢的管道（读取速度由 --reader_rate 字节/秒控制），
+    分别使用同步写入（与 print() 相同）与 LogPipeline 压测 /before-and-after
+
+    python log_pipeline.py --reader_rate=65536 --duration=5 --concurrency=20
+
+    本机结果（--reader_rate=32768，20 个并发用户）：
+        sync     ：约 1000 req/sec，p99 约 106ms（管道写满后 IOLoop 被阻塞）
+        pipeline ：约 3350 req/sec，p99 约 9ms（多出的日志被丢弃并计入 dropped）
+"""
+
+
+def _slow_reader(fd, rate):
+    chunk = 4096
+    while True:
+        data = os.read(fd, chunk)
+        if not data:
+            return
+        time.sleep(len(data) / float(rate))
+
+
+def benchmark(background, reader_rate, duration, concurrency):
+    import multiprocessing
+    import tornado.gen
+    import tornado.ioloop
+    import tornado.testing
+    import tornado.httpserver
+    import http_server
+    from loadgen import LoadGenerator
+
+    read_fd, write_fd = os.pipe()
+    reader = multiprocessing.Process(target=_slow_reader, args=(read_fd, reader_rate), daemon=True)
+    reader.start()
+    os.close(read_fd)
+    stream = os.fdopen(write_fd, 'w')
+
+    pipeline = LogPipeline(stream, background=background)
+    sock, port = tornado.testing.bind_unused_port()
+    server = tornado.httpserver.HTTPServer(http_server.make_app(log_pipeline=pipeline))
+    server.add_sockets([sock])
+
+    @tornado.gen.coroutine
+    def run():
+        generator = LoadGenerator('http://127.0.0.1:%d/before-and-after' % port)
+        result = yield generator.closed_loop(concurrency, duration)
+        generator.close()
+        raise tornado.gen.Return(result)
+
+    result = tornado.ioloop.IOLoop.current().run_sync(run)
+    server.stop()
+    summary = result.histogram.summary()
+    print('%-10s %8.0f req/sec  p50 %7.2fms  p99 %8.2fms  max %8.2fms  %s' % (
+        'pipeline' if background else 'sync', result.requests / result.elapsed,
+        summary['p50'] / 1000.0, summary['p99'] / 1000.0, summary['max'] / 1000.0, pipeline.stats()))
+    reader.terminate()
+    stream.close()
+
+
+if __name__ == '__main__':
+    from tornado.options import define, options, parse_command_line
+    define(name='reader_rate', default=64 * 1024, help='Bytes per second read from the stdout pipe', type=int)
+    define(name='duration', default=5, help='Seconds to run each benchmark', type=float)
+    define(name='concurrency', default=20, help='Concurrent users', type=int)
+    parse_command_line()
+    # 关闭访问日志，避免日志输出影响测试结果
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
+    benchmark(False, options.reader_rate, options.duration, options.concurrency)
+    benchmark(True, options.reader_rate, options.duration, options.concurrency)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+
+import tornado.web
+
+"""
+    模板渲染结果缓存
+
+    对于输入相同、输出也相同的模板路由，重复渲染是没有必要的
+    RenderCache 以 "模板名 + 渲染参数" 作为键缓存渲染后的 HTML 字节串
+
+    要点：
+        1.max_bytes 限制缓存占用的总字节数，超出时按 LRU 规则淘汰
+        2.ttl 秒后缓存条目过期
+        3.缓存条目记录模板文件（包括 extends / include 引用的文件）的修改时间
+          文件被修改后缓存条目失效，并清空 Tornado 的模板加载器缓存以便重新编译
+        4.为避免每次命中都访问文件系统，每个条目最多每 check_interval 秒检查一次修改时间
+
+    注意：缓存的只是响应 Body，模板输出必须完全由参数决定
+    （比如依赖 current_user、xsrf_form_html 的模板不适合使用）
+"""
+
+# 匹配模板中的 {% extends "..." %} 与 {% include "..." %} 语句
+_TEMPLATE_REF_RE = re.compile(r'{%\s*(?:extends|include)\s+["\']([^"\']+)["\']\s*%}')
+
+
+def template_files(template_path, template_name, _seen=None):
+    # 返回模板及其依赖模板的 {绝对路径: 修改时间}
+    # 相对路径的解析规则与 tornado.template.Loader.resolve_path 一致
+    seen = {} if _seen is None else _seen
+    path = os.path.join(template_path, template_name)
+    if path in seen:
+        return seen
+    try:
+        seen[path] = os.path.getmtime(path)
+        with open(path, 'rb') as f:
+            source = f.read().decode('utf-8')
+    except (OSError, UnicodeDecodeError):
+        return seen
+    for name in _TEMPLATE_REF_RE.findall(source):
+        if not name.startswith('/'):
+            name = os.path.normpath(os.path.join(os.path.dirname(template_name), name))
+        template_files(template_path, name, seen)
+    return seen
+
+
+def reset_template_loaders():
+    # 模板文件修改后，清空 Tornado 已编译的模板
+    with tornado.web.RequestHandler._template_loader_lock:
+        for loader in tornado.web.RequestHandler._template_loaders.values():
+            loader.reset()
+
+
+class _Entry(object):
+    __slots__ = ('body', 'files', 'expires', 'checked')
+
+    def __init__(self, body, files, expires, checked):
+        self.body = body
+        self.files = files
+        self.expires = expires
+        self.checked = checked
+
+
+class RenderCache(object):
+
+    def __init__(self, max_bytes=4 * 1024 * 1024, ttl=60, check_interval=1.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.monotonic()
+        changed = False
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now >= entry.expires:
+                self._remove(key)
+                entry = None
+            elif entry is not None and now - entry.checked >= self.check_interval:
+                entry.checked = now
+                if self._changed(entry.files):
+                    self._remove(key)
+                    self.invalidations += 1
+                    entry = None
+                    changed = True
+            if entry is None:
+                self.misses += 1
+                body = None
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                body = entry.body
+        if changed:
+            reset_template_loaders()
+        return body
+
+    def set(self, key, body, files):
+        if len(body) > self.max_bytes:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(body, files, now + self.ttl, now)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                old_key = next(iter(self._entries))
+                self._remove(old_key)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= len(entry.body)
+
+    @staticmethod
+    def _changed(files):
+        for path, mtime in files.items():
+            try:
+                if os.path.getmtime(path) != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+
+class RenderCacheMixin(object):
+    """
+        RequestHandler 混入类
+
+        子类将 render_cache 类属性设置为 RenderCache 实例后即启用缓存（默认不启用）
+        然后使用 cached_render 代替 render 即可
+    """
+
+    render_cache = None
+
+    _render_cache_key = None
+
+    def cached_render(self, template_name, **kwargs):
+        cache = self.render_cache
+        if cache is None:
+            return self.render(template_name, **kwargs)
+        key = (template_name, tuple(sorted(kwargs.items())))
+        try:
+            body = cache.get(key)
+        except TypeError:
+            # 参数不可哈希，无法作为缓存键
+            return self.render(template_name, **kwargs)
+        if body is not None:
+            return self.finish(body)
+        self._render_cache_key = key
+        return self.render(template_name, **kwargs)
+
+    def finish(self, chunk=None):
+        key = self._render_cache_key
+        if key is not None:
+            # render 最终会以完整的 HTML 调用 finish，在这里保存渲染结果
+            self._render_cache_key = None
+            if chunk is not None and self.get_status() == 200:
+                template_path = self.get_template_path()
+                files = template_files(template_path, key[0]) if template_path else {}
+                self.render_cache.set(key, chunk, files)
+        return super(RenderCacheMixin, self).finish(chunk)
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+import tornado.web
+from tornado.routing import PathMatches
+
+"""
+    索引路由
+
+    Tornado 的路由（RuleRouter.find_handler）按顺序逐条用正则匹配请求路径，
+    路由表越大，排在后面的路由以及 404 的匹配代价越高
+
+    IndexedRouter 在第一次匹配时为路由表建立索引：
+        1.固定字符串路径（比如 "/now"）放入字典，一次哈希查找
+        2.正则路径按其固定前缀（比如 "/date/(\\d{4})/..." 的前缀为 "/date/"）放入字符前缀树，
+          沿着请求路径遍历前缀树，只有前缀相同的路由才需要正则匹配
+        3.无法确定前缀的规则（含有 "|"、忽略大小写、非 PathMatches 的规则）前缀为空，对所有请求都要匹配
+
+    与 Tornado 的匹配结果完全一致：
+        字典命中的规则与前缀树中的候选规则一起按照在路由表中的顺序匹配，
+        所以同一路径被多条规则匹配时，仍然是排在前面的规则生效
+
+    install(app) 替换 Application 中保存路由规则的 wildcard_router，
+    每条新规则都经过 process_rule（add_rule、add_rules、add_handlers 都是如此），索引在这里失效，下一次匹配时重建
+
+    注意：IndexedRouter 继承了 Tornado 内部的 _ApplicationRouter（Tornado 5.1），升级 Tornado 时需要确认
+"""
+
+_REGEX_META = frozenset('.^$*+?{}[]|()\\')
+
+
+def static_prefix(pattern):
+    # 返回 (正则表达式能匹配的所有路径的共同前缀, 表达式是否就是这个固定字符串)
+    if pattern.startswith('^'):
+        pattern = pattern[1:]
+    if pattern.endswith('$') and not pattern.endswith('\\$'):
+        pattern = pattern[:-1]
+    if '|' in pattern:
+        # 顶层的 "|" 使前缀失去意义, 保守处理
+        return '', False
+    prefix = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        step = 1
+        if char == '\\':
+            if i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+                # 转义的标点符号, 比如 "\."
+                char = pattern[i + 1]
+                step = 2
+            else:
+                break
+        elif char in _REGEX_META:
+            break
+        quantifier = pattern[i + step:i + step + 1]
+        if quantifier in ('*', '?', '{'):
+            # 这个字符可以不出现
+            break
+        prefix.append(char)
+        i += step
+        if quantifier == '+':
+            break
+    return ''.join(prefix), i == len(pattern)
+
+
+class IndexedRouter(tornado.web._ApplicationRouter):
+
+    def __init__(self, application, rules=None):
+        self._literals = None
+        self._trie = None
+        super(IndexedRouter, self).__init__(application, rules)
+
+    def add_rule(self, matcher, target, target_kwargs=None, name=None):
+        # Tornado 5.1 的 RuleRouter 只有 add_rules, 这里提供添加单条规则的方法
+        self.add_rules([(matcher, target, target_kwargs, name)])
+        return self.rules[-1]
+
+    def process_rule(self, rule):
+        self._literals = None
+        return super(IndexedRouter, self).process_rule(rule)
+
+    def _build(self):
+        literals = {}
+        # 前缀树节点为 [子节点字典, 该前缀下的 (序号, 规则) 列表]
+        trie = [{}, []]
+        for index, rule in enumerate(self.rules):
+            matcher = rule.matcher
+            prefix, literal = '', False
+            if isinstance(matcher, PathMatches) and not matcher.regex.flags & re.IGNORECASE:
+                prefix, literal = static_prefix(matcher.regex.pattern)
+            if literal and not matcher.regex.groups:
+                literals.setdefault(prefix, (index, rule))
+                continue
+            node = trie
+            for char in prefix:
+                node = node[0].setdefault(char, [{}, []])
+            node[1].append((index, rule))
+        self._trie = trie
+        self._literals = literals
+
+    def find_handler(self, request, **kwargs):
+        if self._literals is None:
+            self._build()
+        path = request.path
+        node = self._trie
+        candidates = list(node[1])
+        for char in path:
+            node = node[0].get(char)
+            if node is None:
+                break
+            candidates.extend(node[1])
+        literal = self._literals.get(path)
+        if literal is not None:
+            candidates.append(literal)
+        if len(candidates) > 1:
+            # 按路由表中的顺序匹配
+            candidates.sort(key=lambda item: item[0])
+
+        for index, rule in candidates:
+            target_params = rule.matcher.match(request)
+            if target_params is not None:
+                if rule.target_kwargs:
+                    target_params['target_kwargs'] = rule.target_kwargs
+                delegate = self.get_target_delegate(rule.target, request, **target_params)
+                if delegate is not None:
+                    return delegate
+        return None
+
+
+def install(app):
+    # 用 IndexedRouter 替换 Application 中保存路由规则的 wildcard_router
+    router = IndexedRouter(app, app.wildcard_router.rules)
+    for rule in app.default_router.rules:
+        if rule.target is app.wildcard_router:
+            rule.target = router
+    app.wildcard_router = router
+    return app
+
+
+"""
+    索引路由 - 基准测试
+
+    生成 N 条路由（一半固定路径，一半带参数的正则路径），
+    分别用 Tornado 默认的路由与 IndexedRouter 匹配随机选择的路径以及不存在的路径（404）
+
+    python router.py --number=20000
+
+    本机结果（单次匹配耗时）：
+         路由数    tornado（404）         indexed（404）
+            10     4.5 us（   3.5 us）    4.4 us（1.4 us）
+           100    11.4 us（  16.3 us）    3.4 us（1.3 us）
+          1000    54.7 us（ 103.8 us）    3.4 us（1.5 us）
+         10000   757.6 us（2062.5 us）    3.5 us（1.4 us）
+"""
+
+
+def benchmark(sizes, number):
+    import random
+    import timeit
+    from tornado.httputil import HTTPServerRequest
+
+    class Handler(tornado.web.RequestHandler):
+        pass
+
+    for size in sizes:
+        rules = []
+        paths = []
+        for i in range(size // 2):
+            rules.append(('/section%d/page' % i, Handler))
+            rules.append(('/section%d/item/(\\d+)' % i, Handler))
+            paths.append('/section%d/page' % i)
+            paths.append('/section%d/item/%d' % (i, i))
+        default = tornado.web.Application(rules)
+        indexed = install(tornado.web.Application(rules))
+        random.seed(size)
+        requests = [HTTPServerRequest(uri=path) for path in random.sample(paths, min(len(paths), 100))]
+        missing = HTTPServerRequest(uri='/missing/path')
+        for request in requests:
+            a = default.find_handler(request)
+            b = indexed.find_handler(request)
+            assert a.handler_class is b.handler_class and a.path_args == b.path_args, request.path
+
+        results = []
+        for app in (default, indexed):
+            def run():
+                for request in requests:
+                    app.find_handler(request)
+            elapsed = timeit.timeit(run, number=max(1, number // len(requests)))
+            hit = elapsed / (max(1, number // len(requests)) * len(requests)) * 1e6
+            miss = timeit.timeit(lambda: app.find_handler(missing), number=number) / number * 1e6
+            results.append((hit, miss))
+        print('%6d routes  tornado %9.2f us (404 %9.2f us)  indexed %6.2f us (404 %6.2f us)' % (
+            size, results[0][0], results[0][1], results[1][0], results[1][1]))
+
+
+if __name__ == '__main__':
+    from tornado.options import define, options, parse_command_line
+    define(name='number', default=20000, help='Lookups per case', type=int)
+    parse_command_line()
+    benchmark([10, 100, 1000, 10000], options.number)
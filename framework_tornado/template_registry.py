@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import tornado.template
+
+"""
+    内联模板 - 编译结果注册表
+
+    tornado.template.Template 在初始化时会完成模板解析、生成 Python 代码以及 compile 三个步骤
+    如果在每次请求中都重新构造 Template，那么每次请求都要付出完整的编译开销
+
+    TemplateRegistry 以模板内容的哈希值作为键缓存编译好的 Template 对象
+        1.缓存数量有上限，超出时按 LRU（最近最少使用）规则淘汰
+        2.可以在服务启动时调用 warm 函数预先编译所有内联模板
+        3.compiles / hits 两个计数器分别记录编译次数与命中次数，用于在压测时确认缓存生效
+        4.template_class 为模板类，默认为 tornado.template.Template（流式渲染的模板参考 template_stream.py）
+"""
+
+
+class TemplateRegistry(object):
+
+    def __init__(self, max_size=128, template_class=tornado.template.Template):
+        self.max_size = max_size
+        self.template_class = template_class
+        self.compiles = 0
+        self.hits = 0
+        self._templates = OrderedDict()
+        # 模板可能在线程池中渲染，访问注册表时需要加锁
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(template_string):
+        if isinstance(template_string, str):
+            template_string = template_string.encode('utf-8')
+        return hashlib.sha1(template_string).hexdigest()
+
+    def get(self, template_string, name='<string>'):
+        key = self.key(template_string)
+        with self._lock:
+            temp = self._templates.get(key)
+            if temp is not None:
+                self._templates.move_to_end(key)
+                self.hits += 1
+                return temp
+        # 编译过程不持有锁，并发编译同一模板时只保留先写入的结果
+        temp = self.template_class(template_string=template_string, name=name)
+        with self._lock:
+            self.compiles += 1
+            temp = self._templates.setdefault(key, temp)
+            self._templates.move_to_end(key)
+            while len(self._templates) > self.max_size:
+                self._templates.popitem(last=False)
+        return temp
+
+    def warm(self, template_strings):
+        for template_string in template_strings:
+            self.get(template_string)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._templates),
+                'max_size': self.max_size,
+                'compiles': self.compiles,
+                'hits': self.hits,
+            }
+
+
+# 模块级别的注册表，所有内联模板处理器共用
+TEMPLATE_REGISTRY = TemplateRegistry()
+
+
+def render_inline(template_string, **kwargs):
+    # 渲染内联模板，可以提交到线程池或者进程池（参考 offload.py）
+    # 在进程池中执行时，每个子进程使用自己的注册表，模板在子进程中第一次渲染时编译
+    return TEMPLATE_REGISTRY.get(template_string).generate(**kwargs)
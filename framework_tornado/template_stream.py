@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+import tornado.gen
+import tornado.template
+
+from template_registry import TemplateRegistry
+
+"""
+    流式模板渲染
+
+    tornado.template.Template 把模板编译成一个 _tt_execute 函数：
+    所有输出片段先 _tt_append 到 _tt_buffer 列表，最后 join 成一个完整的 bytes 返回
+    大列表的模板（比如 10 万项的 {% for %}）要等整个页面渲染完才能发送第一个字节，
+    渲染过程中 _tt_buffer 中的片段与 join 的结果同时占用内存
+
+    StreamingTemplate 改写生成的 Python 代码，把 _tt_execute 变成生成器：
+        1.每次 _tt_append 之后检查 _tt_buffer 中的片段数，达到 flush_every 时 yield 已有的内容并清空 _tt_buffer
+        2.最后的 return 改为 yield 剩余的内容
+        3.{% apply %} 等生成的嵌套函数有自己的 _tt_buffer，不做改写
+    generate(**kwargs) 返回 bytes 块的生成器，把所有块拼接起来与 Template.generate 的结果完全相同
+
+    StreamingRenderMixin.render_stream(template_string, **kwargs) 渲染内联模板，
+    每得到一块就 write 并 flush（等待数据写入套接字后再渲染下一块），
+    首字节时间不再取决于页面大小，内存占用也与页面大小无关，渲染的间隙 IOLoop 可以处理其他连接
+
+    注意：
+        1.一旦开始 flush，响应头就已经发出，渲染中途出错时只能断开连接，无法再返回错误页面
+        2.分块发送的响应使用 Transfer-Encoding: chunked，没有 Content-Length，Tornado 也不会计算 Etag
+"""
+
+_APPEND = re.compile(r'^(\s*)_tt_append\(')
+_DEF = re.compile(r'^(\s*)def ')
+_RETURN = '    return _tt_utf8(\'\').join(_tt_buffer)'
+
+
+def streaming_code(code, flush_every):
+    # 把 Template 生成的 _tt_execute 函数改写为生成器
+    lines = []
+    nested = None
+    for line in code.splitlines():
+        indent = len(line) - len(line.lstrip())
+        if nested is not None and line.strip() and indent <= nested:
+            nested = None
+        match = _DEF.match(line)
+        if nested is None and match and indent > 0:
+            # 嵌套函数（比如 {% apply %}）有自己的 _tt_buffer, 不做改写
+            nested = indent
+        if nested is None and line.startswith(_RETURN):
+            lines.append('    if _tt_buffer: yield _tt_utf8(\'\').join(_tt_buffer)')
+            continue
+        lines.append(line)
+        match = _APPEND.match(line)
+        if nested is None and match:
+            lines.append('%sif len(_tt_buffer) >= %d: yield _tt_utf8(\'\').join(_tt_buffer); del _tt_buffer[:]' % (
+                match.group(1), flush_every))
+    return '\n'.join(lines) + '\n'
+
+
+class StreamingTemplate(tornado.template.Template):
+    """
+        generate 返回 bytes 块的生成器
+    """
+
+    flush_every = 4096
+
+    def _generate_python(self, loader):
+        return streaming_code(super(StreamingTemplate, self)._generate_python(loader), self.flush_every)
+
+
+# 流式渲染的内联模板注册表
+STREAMING_REGISTRY = TemplateRegistry(template_class=StreamingTemplate)
+
+
+class StreamingRenderMixin(object):
+    """
+        RequestHandler 混入类
+    """
+
+    @tornado.gen.coroutine
+    def render_stream(self, template_string, **kwargs):
+        temp = STREAMING_REGISTRY.get(template_string)
+        for chunk in temp.generate(**kwargs):
+            self.write(chunk)
+            yield self.flush()
+        self.finish()
+
+
+"""
+    流式模板渲染 - 基准测试
+
+    每种情况在子进程中启动一个新的 http_server（不卸载渲染，模板在 IOLoop 线程中渲染），
+    请求一次 /ctlflow-temp?n=--render_items，比较完整渲染与 ?stream=1 流式渲染的：
+        首字节时间（TTFB）、完整响应时间，以及服务进程处理请求前后的峰值内存（VmHWM）增量
+
+    python template_stream.py --render_items=100000
+
+    本机结果：
+         列表长度    完整渲染 TTFB / 峰值内存增量     流式渲染 TTFB / 峰值内存增量     响应大小
+           1 万         7.1 ms /   3.4 MB              1.3 ms / 0.5 MB                 0.4 MB
+          10 万        70.2 ms /  34.0 MB              1.3 ms / 0.5 MB                 4.4 MB
+         100 万       674.4 ms / 341.8 MB              1.3 ms / 0.4 MB                44.9 MB
+    两种方式的完整响应时间基本相同
+"""
+
+
+def peak_rss_kb(pid):
+    with open('/proc/%d/status' % pid) as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return 0
+
+
+def fetch_timed(port, path):
+    # 返回 (首字节时间, 完整响应时间, 响应字节数), 时间单位为秒
+    import time
+    import socket
+    sock = socket.create_connection(('127.0.0.1', port))
+    begin = time.perf_counter()
+    sock.sendall(('GET %s HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n' % path).encode('ascii'))
+    first = None
+    size = 0
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        if first is None:
+            first = time.perf_counter() - begin
+        size += len(data)
+    sock.close()
+    return first, time.perf_counter() - begin, size
+
+
+def benchmark(items, port):
+    import multiprocessing
+    from tornado.options import options
+    from loadgen import serve
+
+    options.admission = False
+    options.offload_threads = 0
+    options.offload_processes = 0
+    for name, query in (('full', ''), ('stream', '&stream=1')):
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=serve, args=(port, ready), daemon=True)
+        server.start()
+        ready.wait()
+        try:
+            # 先请求一次小页面, 排除模板编译等一次性开销
+            fetch_timed(port, '/ctlflow-temp?n=10' + query)
+            before = peak_rss_kb(server.pid)
+            ttfb, total, size = fetch_timed(port, '/ctlflow-temp?n=%d%s' % (items, query))
+            after = peak_rss_kb(server.pid)
+            print('%-6s  TTFB %8.2f ms  total %8.2f ms  %9d bytes  peak RSS +%d KB' % (
+                name, ttfb * 1000, total * 1000, size, after - before))
+        finally:
+            server.terminate()
+            server.join()
+        port += 1
+
+
+if __name__ == '__main__':
+    # 导入 http_server 以定义 port、offload_threads 等选项
+    import http_server
+    from tornado.options import define, options, parse_command_line
+    define(name='render_items', default=100000, help='Length of the rendered list', type=int)
+    parse_command_line()
+    benchmark(options.render_items, options.port)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+import hmac
+import time
+import base64
+import hashlib
+
+"""
+    无状态签名令牌
+
+    会话模式下 Cookie 中只有会话 ID，用户身份保存在会话存储中（参考 session_store.py），
+    每个请求都要查询一次会话存储，多台机器部署时需要一个共享的存储
+
+    TokenSigner 把用户身份与过期时间直接写进令牌并签名，任何持有密钥的进程都可以独立校验，不需要任何查找：
+        1.令牌格式为 "密钥 ID.载荷.签名"，三段都只含 URL 安全字符，可以直接放在 Cookie 或者 Authorization 请求头中
+            密钥 ID ：签名密钥 sha256 摘要的前 8 个十六进制字符
+            载荷    ：base64url("过期时间戳|用户身份")
+            签名    ：base64url(HMAC-SHA256(密钥, "密钥 ID.载荷"))
+        2.secrets 为密钥列表，第一个密钥用于签发，所有密钥都可以用于校验
+          轮换密钥时把新密钥放在列表最前面，旧密钥保留至少 ttl 秒（旧令牌全部过期）后再移除
+        3.校验时按密钥 ID 选择密钥，签名使用 hmac.compare_digest 比较，过期的令牌视为无效
+
+    注意：
+        1.令牌在过期之前无法撤销（退出登录只能删除客户端的 Cookie），ttl 不宜过长
+        2.载荷只签名不加密，不能放入敏感信息
+        3.所有进程与机器必须配置相同的密钥列表（--cookie_secrets）
+"""
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def key_id(secret):
+    return hashlib.sha256(secret.encode('utf-8')).hexdigest()[:8]
+
+
+class TokenSigner(object):
+
+    def __init__(self, secrets, ttl=24 * 3600):
+        if isinstance(secrets, str):
+            secrets = [secrets]
+        if not secrets:
+            raise ValueError('At least one secret is required')
+        self.ttl = ttl
+        self.issued = 0
+        self.verified = 0
+        self.failures = 0
+        self.expirations = 0
+        self._signing_kid = key_id(secrets[0])
+        self._keys = {}
+        for secret in secrets:
+            self._keys.setdefault(key_id(secret), secret.encode('utf-8'))
+
+    def _signature(self, key, signed):
+        return _b64encode(hmac.new(key, signed.encode('ascii'), hashlib.sha256).digest())
+
+    def issue(self, identity, ttl=None):
+        # 返回 str 令牌, identity 为用户身份（str）
+        expires = int(time.time()) + (self.ttl if ttl is None else ttl)
+        payload = _b64encode(('%d|%s' % (expires, identity)).encode('utf-8'))
+        signed = '%s.%s' % (self._signing_kid, payload)
+        self.issued += 1
+        return '%s.%s' % (signed, self._signature(self._keys[self._signing_kid], signed))
+
+    def verify(self, token):
+        # 返回令牌中的用户身份, 令牌为空、格式错误、签名不符或者已过期时返回 None
+        if not token:
+            return None
+        parts = token.split('.')
+        if len(parts) != 3:
+            self.failures += 1
+            return None
+        kid, payload, signature = parts
+        key = self._keys.get(kid)
+        if key is None:
+            # 未知的密钥（已经移除的旧密钥或者伪造的令牌）
+            self.failures += 1
+            return None
+        try:
+            expected = self._signature(key, '%s.%s' % (kid, payload))
+            # compare_digest 比较含非 ASCII 字符的 str 时抛出 TypeError, 先转换为 bytes
+            signature = signature.encode('ascii')
+        except UnicodeEncodeError:
+            self.failures += 1
+            return None
+        if not hmac.compare_digest(expected.encode('ascii'), signature):
+            self.failures += 1
+            return None
+        try:
+            expires, _, identity = _b64decode(payload).decode('utf-8').partition('|')
+            expires = int(expires)
+        except ValueError:
+            self.failures += 1
+            return None
+        if expires <= time.time():
+            self.expirations += 1
+            return None
+        self.verified += 1
+        return identity
+
+    def stats(self):
+        return {
+            'keys': list(self._keys),
+            'signing_key': self._signing_kid,
+            'issued': self.issued,
+            'verified': self.verified,
+            'failures': self.failures,
+            'expirations': self.expirations,
+        }
+
+
+"""
+    无状态签名令牌 - 基准测试
+
+    比较会话模式（校验安全 Cookie + 查询会话存储）与令牌模式（校验令牌）认证一个请求的耗时，
+    会话模式只计算进程内存储，SQLite 或者远程存储还要加上一次查询的往返
+
+    python token_auth.py --number=100000
+
+    本机结果：会话模式（进程内存储）约 5.6 us，令牌模式约 2.6 us（当前密钥与轮换前的旧密钥相同），令牌长度 75 字符
+"""
+
+
+def benchmark(number):
+    import timeit
+    import tornado.web
+    from session_store import MemorySessionStore
+
+    secret = 'SALT'
+    store = MemorySessionStore()
+    store.set('d5f0a0c2-7f2b-11e9-8f9e-2a86e4085a59', 'alice')
+    cookie = tornado.web.create_signed_value(secret, 'session_id', 'd5f0a0c2-7f2b-11e9-8f9e-2a86e4085a59')
+    signer = TokenSigner(['NEW-SALT', secret])
+    token = signer.issue('alice')
+    old_token = TokenSigner([secret]).issue('alice')
+
+    def session():
+        session_id = tornado.web.decode_signed_value(secret, 'session_id', cookie)
+        return store.get(session_id.decode('utf-8'))
+
+    assert session() == signer.verify(token) == signer.verify(old_token) == 'alice'
+    # 格式错误、含非 ASCII 字符或者签名被篡改的令牌都视为无效
+    kid, payload, signature = token.split('.')
+    for bad in ('', 'abc', token + '.x', '%s.bbbb.cc\xe9' % kid, '%s.%s.%s\xe9' % (kid, payload, signature[:-1]),
+                '%s.%s\xe9.%s' % (kid, payload, signature), '%s.%s.%s' % (kid, payload, signature[::-1])):
+        assert signer.verify(bad) is None, bad
+    for name, func in (('session cookie + store', session), ('token (current key)', lambda: signer.verify(token)),
+                       ('token (rotated key)', lambda: signer.verify(old_token))):
+        elapsed = timeit.timeit(func, number=number)
+        print('%-24s %6.2f us/op' % (name, elapsed / number * 1e6))
+    print('token length: %d' % len(token))
+
+
+if __name__ == '__main__':
+    from tornado.options import define, options, parse_command_line
+    define(name='number', default=100000, help='Verifications per case', type=int)
+    parse_command_line()
+    benchmark(options.number)
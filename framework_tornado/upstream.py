@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import datetime
+import functools
+from collections import OrderedDict
+
+import tornado.gen
+import tornado.locks
+import tornado.ioloop
+import tornado.httpclient
+from tornado.concurrent import Future
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+
+try:
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+    # pycurl 未安装
+    CurlAsyncHTTPClient = None
+
+from urllib.parse import urlsplit
+
+logger = logging.getLogger('upstream')
+
+"""
+    上游请求 - 合并与缓存
+
+    网站转发类的处理器（比如 AsyncSSRHandler、CoroutineHandler）每次请求都会向上游发起一次请求
+    突发流量下大量相同的上游请求是没有必要的
+
+    SingleFlightFetcher 对相同 URL 的上游请求进行合并与缓存
+        1.合并（single-flight）：同一时刻相同 URL 只有一个上游请求在进行，
+          其它并发请求共享这一个请求的 Future
+        2.缓存：ttl 秒内直接返回上一次成功的响应（ttl 为 0 时不缓存）
+        3.过期后仍可用（stale-while-revalidate）：缓存过期后的 stale_ttl 秒内，
+          先返回过期的响应，同时在后台发起一次（同样被合并的）请求刷新缓存
+
+    计数器：
+        hits      ：命中新鲜缓存
+        stale     ：命中过期缓存并触发后台刷新
+        coalesced ：合并到正在进行的上游请求
+        misses    ：实际发起上游请求
+        errors    ：上游请求失败（失败的响应不会被缓存）
+
+    注意：所有请求共享同一个 HTTPResponse 对象，不能修改它
+"""
+
+
+class SingleFlightFetcher(object):
+
+    def __init__(self, ttl=0, stale_ttl=0, max_entries=1024, http_client=None):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.http_client = http_client
+        self.hits = 0
+        self.stale = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.errors = 0
+        self._cache = OrderedDict()
+        self._inflight = {}
+
+    def fetch(self, url, callback=None):
+        # 返回 Future，结果为 HTTPResponse（上游出错时 response.error 不为空，不会抛出异常）
+        # 与 AsyncHTTPClient.fetch 一样也支持回调函数的方式
+        future = self._fetch(url)
+        if callback is not None:
+            tornado.ioloop.IOLoop.current().add_future(
+                future, lambda f: callback(f.result()))
+        return future
+
+    def _fetch(self, url):
+        cached = self._cache.get(url)
+        if cached is not None:
+            response, fetched_at = cached
+            age = time.monotonic() - fetched_at
+            if age < self.ttl:
+                self.hits += 1
+                return self._resolved(response)
+            if age < self.ttl + self.stale_ttl:
+                self.stale += 1
+                if url not in self._inflight:
+                    self._start(url)
+                return self._resolved(response)
+            del self._cache[url]
+        future = self._inflight.get(url)
+        if future is not None:
+            self.coalesced += 1
+            return future
+        self.misses += 1
+        return self._start(url)
+
+    def _start(self, url):
+        http_client = self.http_client or tornado.httpclient.AsyncHTTPClient()
+        future = Future()
+        self._inflight[url] = future
+        fetch_future = http_client.fetch(url, raise_error=False)
+        fetch_future.add_done_callback(functools.partial(self._on_fetched, url, future))
+        return future
+
+    def _on_fetched(self, url, future, fetch_future):
+        del self._inflight[url]
+        error = fetch_future.exception()
+        if error is not None:
+            # raise_error=False 时一般不会走到这里，保险起见按 599 处理
+            self.errors += 1
+            response = tornado.httpclient.HTTPResponse(
+                tornado.httpclient.HTTPRequest(url), 599, error=error)
+        else:
+            response = fetch_future.result()
+            if response.error:
+                self.errors += 1
+            elif self.ttl or self.stale_ttl:
+                self._cache[url] = (response, time.monotonic())
+                self._cache.move_to_end(url)
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+        future.set_result(response)
+
+    @staticmethod
+    def _resolved(response):
+        future = Future()
+        future.set_result(response)
+        return future
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'stale': self.stale,
+            'coalesced': self.coalesced,
+            'misses': self.misses,
+            'errors': self.errors,
+            'inflight': len(self._inflight),
+            'cached': len(self._cache),
+        }
+
+
+"""
+    上游请求 - 连接池
+
+    在处理器中直接构造 AsyncHTTPClient() 无法控制并发数、单个主机的连接数以及连接复用
+    UpstreamPool 是应用级别共享的上游客户端，所有转发类处理器都通过它发起请求
+
+    要点：
+        1.impl 指定客户端实现
+            curl   ：CurlAsyncHTTPClient，基于 libcurl，空闲连接保持 keep-alive 并被后续请求复用
+            simple ：SimpleAsyncHTTPClient，Tornado 自带实现，每个请求都会新建连接（Connection: close）
+            auto   ：安装了 pycurl 时使用 curl，否则使用 simple
+        2.max_clients 限制同时进行的请求总数，max_per_host 限制同一主机同时进行的请求数
+        3.超出 max_per_host 的请求排队等待，超过 queue_timeout 秒仍未轮到则以 599 失败
+        4.统计排队次数、排队时间与排队超时次数，用于观察上游是否成为瓶颈
+
+    注意：AsyncHTTPClient 与 IOLoop 绑定，多进程时每个工作进程在各自的 IOLoop 中创建客户端
+"""
+
+
+class UpstreamPool(object):
+
+    def __init__(self, impl='auto', max_clients=100, max_per_host=20, queue_timeout=5.0, **defaults):
+        if impl == 'auto':
+            impl = 'curl' if CurlAsyncHTTPClient is not None else 'simple'
+        if impl == 'curl' and CurlAsyncHTTPClient is None:
+            raise ValueError('impl "curl" requires pycurl')
+        if impl not in ('curl', 'simple'):
+            raise ValueError('Unknown upstream client implementation: %s' % impl)
+        if impl == 'simple':
+            logger.info('Upstream pool uses SimpleAsyncHTTPClient, connections are not reused.')
+        self.impl = impl
+        self.max_clients = max_clients
+        self.max_per_host = max_per_host
+        self.queue_timeout = queue_timeout
+        self.defaults = defaults
+        self.requests = 0
+        self.active = 0
+        self.waiting = 0
+        self.queued = 0
+        self.queue_timeouts = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self._client = None
+        self._client_loop = None
+        self._hosts = {}
+
+    def client(self):
+        io_loop = tornado.ioloop.IOLoop.current()
+        if self._client is None or self._client_loop is not io_loop:
+            client_class = CurlAsyncHTTPClient if self.impl == 'curl' else SimpleAsyncHTTPClient
+            self._client = client_class(force_instance=True, max_clients=self.max_clients,
+                                        defaults=self.defaults)
+            self._client_loop = io_loop
+            self._hosts = {}
+        return self._client
+
+    @tornado.gen.coroutine
+    def fetch(self, request, raise_error=True, **kwargs):
+        # 与 AsyncHTTPClient.fetch 用法相同
+        if not isinstance(request, tornado.httpclient.HTTPRequest):
+            request = tornado.httpclient.HTTPRequest(request, **kwargs)
+        client = self.client()
+        host = urlsplit(request.url).netloc
+        semaphore = self._hosts.get(host)
+        if semaphore is None:
+            semaphore = self._hosts[host] = tornado.locks.Semaphore(self.max_per_host)
+        self.requests += 1
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            yield semaphore.acquire(timeout=datetime.timedelta(seconds=self.queue_timeout))
+        except tornado.gen.TimeoutError:
+            self.queue_timeouts += 1
+            error = tornado.httpclient.HTTPError(599, 'Timeout while waiting in upstream queue')
+            if raise_error:
+                raise error
+            raise tornado.gen.Return(tornado.httpclient.HTTPResponse(
+                request, 599, error=error, request_time=time.monotonic() - start))
+        finally:
+            self.waiting -= 1
+        wait = time.monotonic() - start
+        if wait > 0.001:
+            self.queued += 1
+        self.queue_wait_total += wait
+        self.queue_wait_max = max(self.queue_wait_max, wait)
+        self.active += 1
+        try:
+            response = yield client.fetch(request, raise_error=raise_error)
+        finally:
+            self.active -= 1
+            semaphore.release()
+        raise tornado.gen.Return(response)
+
+    def stats(self):
+        return {
+            'impl': self.impl,
+            'requests': self.requests,
+            'active': self.active,
+            'waiting': self.waiting,
+            'queued': self.queued,
+            'queue_timeouts': self.queue_timeouts,
+            'queue_wait_avg_ms': self.queue_wait_total / self.requests * 1000 if self.requests else 0.0,
+            'queue_wait_max_ms': self.queue_wait_max * 1000,
+        }
+
+
+"""
+    上游请求 - 连接复用基准测试
+
+    在本地启动一个上游服务并统计它接受的连接数，
+    分别使用 simple 与 curl 实现发送相同数量的请求，比较连接数与吞吐量
+
+    python upstream.py --requests=2000 --concurrency=20
+"""
+
+
+def benchmark(impl, requests, concurrency):
+    import tornado.web
+    import tornado.httpserver
+    import tornado.testing
+
+    connections = [0]
+
+    class CountingHTTPServer(tornado.httpserver.HTTPServer):
+        def handle_stream(self, stream, address):
+            connections[0] += 1
+            return super(CountingHTTPServer, self).handle_stream(stream, address)
+
+    class IPHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.write({'origin': self.request.remote_ip})
+
+    sock, port = tornado.testing.bind_unused_port()
+    server = CountingHTTPServer(tornado.web.Application([('/ip', IPHandler)]))
+    server.add_sockets([sock])
+    pool = UpstreamPool(impl=impl, max_clients=concurrency, max_per_host=concurrency)
+    url = 'http://127.0.0.1:%d/ip' % port
+
+    @tornado.gen.coroutine
+    def worker(count):
+        for _ in range(count):
+            yield pool.fetch(url)
+
+    @tornado.gen.coroutine
+    def run():
+        begin = time.time()
+        yield [worker(requests // concurrency) for _ in range(concurrency)]
+        raise tornado.gen.Return(time.time() - begin)
+
+    elapsed = tornado.ioloop.IOLoop.current().run_sync(run)
+    server.stop()
+    pool.client().close()
+    total = requests // concurrency * concurrency
+    print('%-6s %6d requests  %6d connections  %8.0f req/sec  queue wait avg %.2fms' % (
+        impl, total, connections[0], total / elapsed, pool.stats()['queue_wait_avg_ms']))
+
+
+if __name__ == '__main__':
+    from tornado.options import define, options, parse_command_line
+    define(name='requests', default=2000, help='Number of requests', type=int)
+    define(name='concurrency', default=20, help='Number of concurrent requests', type=int)
+    parse_command_line()
+    # 关闭访问日志，避免日志输出影响测试结果
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
+    benchmark('simple', options.requests, options.concurrency)
+    if CurlAsyncHTTPClient is not None:
+        benchmark('curl', options.requests, options.concurrency)
+    else:
+        print('pycurl is not installed, skip curl benchmark.')